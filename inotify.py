@@ -7,19 +7,46 @@ working with asyncio.
 # Licensed under the GNU Lesser General Public License v2.1 or later.
 #-
 
+import sys
 import os
 import enum
 import ctypes as ct
 import struct
+import array
+import time
+import itertools
+import bisect
+import mmap
+import hashlib
+import zlib
+from collections import \
+    deque, \
+    namedtuple, \
+    OrderedDict
+import fcntl
+import select
+import selectors
+import threading
+import termios
+from errno import \
+    ENOSPC
 from weakref import \
     ref as weak_ref, \
     WeakValueDictionary
 import asyncio
 import atexit
+try :
+    import numpy
+except ImportError :
+    numpy = None
+#end try
 
 libc = ct.CDLL("libc.so.6", use_errno = True)
 
 NAME_MAX = 255 # from <linux/limits.h>
+READ_BUFSIZE_MAX = 1 << 20 # upper limit on auto-grown read buffer
+FULLPATH_CACHE_MAX = 4096 # entries kept per Watcher for Event.fullpath
+MAX_USER_WATCHES_PATH = "/proc/sys/fs/inotify/max_user_watches"
 
 class inotify_event(ct.Structure) :
     # from <sys/inotify.h>
@@ -100,6 +127,14 @@ class IN :
 
 #end IN
 
+# events that affect directory snapshots kept for recover_overflow:
+_SNAPSHOT_EVENTS = \
+    (
+        IN.Q_OVERFLOW
+    |
+        IN.CREATE | IN.DELETE | IN.MOVE | IN.MODIFY | IN.ATTRIB | IN.CLOSE_WRITE
+    )
+
 @enum.unique
 class EVENT_BIT(enum.IntEnum) :
     "names for single bits in mask; value is bit number."
@@ -169,31 +204,870 @@ def decode_mask(mask) :
         mask_bits
 #end decode_mask
 
+def max_user_watches() :
+    "returns the system limit on the number of inotify watches per user, as read" \
+    " from MAX_USER_WATCHES_PATH, or None if it cannot be read."
+    try :
+        with open(MAX_USER_WATCHES_PATH) as infile :
+            result = int(infile.read())
+        #end with
+    except (OSError, ValueError) :
+        result = None
+    #end try
+    return \
+        result
+#end max_user_watches
+
+_event_struct = struct.Struct("@iIII") # layout of inotify_event, precompiled
+
+def _pending_bytes(fd) :
+    # returns the number of bytes waiting to be read from the inotify queue on fd.
+    count = bytearray(ct.sizeof(ct.c_int))
+    fcntl.ioctl(fd, termios.FIONREAD, count, True)
+    return \
+        ct.c_int.from_buffer(count).value
+#end _pending_bytes
+
+def _parse_events(buf, nbytes) :
+    # decodes the first nbytes of buf, which holds raw inotify_event records
+    # as read from the kernel, into a list of (wd, mask, cookie, name) tuples,
+    # where name is bytes with trailing NULs removed. Walks the buffer by
+    # offset, so only the names are copied out of it.
+    unpack_from = _event_struct.unpack_from
+    fixed_size = _event_struct.size
+    result = []
+    pos = 0
+    with memoryview(buf) as view :
+        while pos < nbytes :
+            assert nbytes - pos >= fixed_size, "truncated inotify message: expected %d bytes, got %d" % (fixed_size, nbytes - pos)
+            wd, mask, cookie, namelen = unpack_from(buf, pos)
+            pos += fixed_size
+            if namelen != 0 :
+                assert nbytes - pos >= namelen, "truncated rest of inotify message: expected %d bytes, got %d" % (namelen, nbytes - pos)
+                end = buf.find(0, pos, pos + namelen)
+                if end < 0 :
+                    end = pos + namelen
+                #end if
+                name = view[pos:end].tobytes()
+                pos += namelen
+            else :
+                name = b""
+            #end if
+            result.append((wd, mask, cookie, name))
+        #end while
+    #end with
+    return \
+        result
+#end _parse_events
+
+class EventBatch :
+    "a batch of raw events in columnar form, as passed to a handler installed" \
+    " with Watcher.set_raw_handler(…, columnar = True). wd, mask and cookie are" \
+    " parallel arrays of int32, uint32 and uint32 respectively; the name of" \
+    " event i is names[name_start[i]:name_end[i]]. The arrays are NumPy arrays" \
+    " if NumPy is installed, otherwise array.array objects; the select() and" \
+    " count_by_wd() methods are vectorized in the former case."
+
+    __slots__ = ("wd", "mask", "cookie", "name_start", "name_end", "names") # to forestall typos
+
+    def __init__(self, wd, mask, cookie, name_start, name_end, names) :
+        if numpy != None :
+            wd, mask, cookie, name_start, name_end = \
+                (
+                    (
+                        lambda : numpy.frombuffer(col, dtype = dtype),
+                        lambda : col,
+                    )[isinstance(col, numpy.ndarray)]()
+                    for col, dtype in
+                        (
+                            (wd, numpy.int32),
+                            (mask, numpy.uint32),
+                            (cookie, numpy.uint32),
+                            (name_start, numpy.uint32),
+                            (name_end, numpy.uint32),
+                        )
+                )
+        #end if
+        self.wd = wd
+        self.mask = mask
+        self.cookie = cookie
+        self.name_start = name_start
+        self.name_end = name_end
+        self.names = names
+    #end __init__
+
+    @classmethod
+    def from_buffer(celf, buf, nbytes) :
+        "decodes the first nbytes of buf, holding raw inotify_event records as" \
+        " read from the kernel, into a new EventBatch. The names blob is a copy" \
+        " of the buffer, so buf may be reused afterwards."
+        unpack_from = _event_struct.unpack_from
+        fixed_size = _event_struct.size
+        wds = array.array("i")
+        masks = array.array("I")
+        cookies = array.array("I")
+        starts = array.array("I")
+        ends = array.array("I")
+        names = bytes(memoryview(buf)[:nbytes])
+        pos = 0
+        while pos < nbytes :
+            wd, mask, cookie, namelen = unpack_from(names, pos)
+            pos += fixed_size
+            wds.append(wd)
+            masks.append(mask)
+            cookies.append(cookie)
+            starts.append(pos)
+            if namelen != 0 :
+                end = names.find(0, pos, pos + namelen)
+                if end < 0 :
+                    end = pos + namelen
+                #end if
+                ends.append(end)
+                pos += namelen
+            else :
+                ends.append(pos)
+            #end if
+        #end while
+        return \
+            celf(wds, masks, cookies, starts, ends, names)
+    #end from_buffer
+
+    @classmethod
+    def from_records(celf, records) :
+        "constructs a new EventBatch from a sequence of (wd, mask, cookie, name) tuples."
+        wds = array.array("i")
+        masks = array.array("I")
+        cookies = array.array("I")
+        starts = array.array("I")
+        ends = array.array("I")
+        names = []
+        pos = 0
+        for wd, mask, cookie, name in records :
+            wds.append(wd)
+            masks.append(mask)
+            cookies.append(cookie)
+            starts.append(pos)
+            pos += len(name)
+            ends.append(pos)
+            names.append(name)
+        #end for
+        return \
+            celf(wds, masks, cookies, starts, ends, b"".join(names))
+    #end from_records
+
+    def __len__(self) :
+        return \
+            len(self.wd)
+    #end __len__
+
+    def name(self, i) :
+        "returns the name of event i as bytes."
+        return \
+            self.names[self.name_start[i] : self.name_end[i]]
+    #end name
+
+    def __iter__(self) :
+        "yields (wd, mask, cookie, name) tuples, as passed to a non-columnar raw handler."
+        names = self.names
+        for wd, mask, cookie, start, end in \
+            zip(self.wd, self.mask, self.cookie, self.name_start, self.name_end) \
+        :
+            yield int(wd), int(mask), int(cookie), names[start:end]
+        #end for
+    #end __iter__
+
+    def select(self, mask = None, wds = None) :
+        "returns a new EventBatch containing only those events that have any of" \
+        " the bits in mask set (if mask is not None) and whose wd is in the" \
+        " collection wds (if wds is not None). The new batch shares the names blob."
+        if numpy != None :
+            keep = numpy.ones(len(self.wd), dtype = bool)
+            if mask != None :
+                keep &= self.mask & numpy.uint32(mask) != 0
+            #end if
+            if wds != None :
+                keep &= numpy.isin(self.wd, numpy.fromiter(wds, dtype = numpy.int32))
+            #end if
+            result = type(self) \
+              (
+                self.wd[keep],
+                self.mask[keep],
+                self.cookie[keep],
+                self.name_start[keep],
+                self.name_end[keep],
+                self.names
+              )
+        else :
+            if wds != None and not isinstance(wds, (set, frozenset, dict)) :
+                wds = frozenset(wds)
+            #end if
+            keep = \
+                [
+                    i
+                    for i in range(len(self.wd))
+                    if
+                            (mask == None or self.mask[i] & mask != 0)
+                        and
+                            (wds == None or self.wd[i] in wds)
+                ]
+            result = type(self) \
+              (
+                *(
+                    array.array(col.typecode, (col[i] for i in keep))
+                    for col in (self.wd, self.mask, self.cookie, self.name_start, self.name_end)
+                ),
+                self.names
+              )
+        #end if
+        return \
+            result
+    #end select
+
+    def count_by_wd(self, mask = None) :
+        "returns a dict mapping each wd to the number of events for it, optionally" \
+        " counting only events with any of the bits in mask set."
+        if mask != None :
+            batch = self.select(mask = mask)
+        else :
+            batch = self
+        #end if
+        if numpy != None :
+            wds, counts = numpy.unique(batch.wd, return_counts = True)
+            result = dict(zip(wds.tolist(), counts.tolist()))
+        else :
+            result = {}
+            for wd in batch.wd :
+                result[wd] = result.get(wd, 0) + 1
+            #end for
+        #end if
+        return \
+            result
+    #end count_by_wd
+
+#end EventBatch
+
+class _EventQueue :
+    # FIFO of pending raw event records, stored column-wise in arrays, which
+    # takes a fraction of the memory of the equivalent Event objects. Names
+    # are kept as the bytes objects from _parse_events, the empty name being
+    # shared by all records without one. Records are identified by a sequence
+    # number which stays valid until they are removed.
+
+    __slots__ = ("wd", "mask", "cookie", "names", "head", "base")
+
+    COMPACT_MIN = 4096 # don’t bother compacting until this many records consumed
+
+    def __init__(self) :
+        self.wd = array.array("i")
+        self.mask = array.array("I")
+        self.cookie = array.array("I")
+        self.names = []
+        self.head = 0 # index of first record not yet consumed
+        self.base = 0 # sequence number of record at index 0
+    #end __init__
+
+    def __len__(self) :
+        return \
+            len(self.wd) - self.head
+    #end __len__
+
+    def append(self, wd, mask, cookie, name) :
+        "appends a record and returns its sequence number."
+        self.wd.append(wd)
+        self.mask.append(mask)
+        self.cookie.append(cookie)
+        self.names.append(name)
+        return \
+            self.base + len(self.names) - 1
+    #end append
+
+    def or_mask(self, seq, mask) :
+        "merges mask into the mask of the record with the given sequence number."
+        self.mask[seq - self.base] |= mask
+    #end or_mask
+
+    def popleft(self) :
+        "removes and returns the oldest record as a (seq, wd, mask, cookie, name) tuple."
+        i = self.head
+        result = (self.base + i, self.wd[i], self.mask[i], self.cookie[i], self.names[i])
+        i += 1
+        self.head = i
+        if i == len(self.names) or i >= self.COMPACT_MIN and i * 2 >= len(self.names) :
+            # discard storage for consumed records
+            del self.wd[:i]
+            del self.mask[:i]
+            del self.cookie[:i]
+            del self.names[:i]
+            self.head = 0
+            self.base += i
+        #end if
+        return \
+            result
+    #end popleft
+
+    def drop_first(self, keep) :
+        "removes the oldest record whose mask has none of the bits in keep, if any," \
+        " returning True if one was found. Any records ahead of it move up one" \
+        " place, changing their sequence numbers."
+        i = self.head
+        end = len(self.names)
+        while i < end and self.mask[i] & keep != 0 :
+            i += 1
+        #end while
+        if i < end :
+            while i > self.head :
+                self.wd[i] = self.wd[i - 1]
+                self.mask[i] = self.mask[i - 1]
+                self.cookie[i] = self.cookie[i - 1]
+                self.names[i] = self.names[i - 1]
+                i -= 1
+            #end while
+            self.popleft()
+        #end if
+        return \
+            i < end
+    #end drop_first
+
+#end _EventQueue
+
+class _WatchTable :
+    # the structure of the set of watches belonging to a Watcher. Each watch is
+    # a node keyed by its wd, holding the wd of its parent and its own name
+    # component. A watch that is not within a tree set up by watch_tree() is a
+    # root, with parent -1 and its full pathname as its name. Full paths are
+    # derived on demand, so renaming a directory only has to update one node.
+    # Node attributes are kept in arrays indexed by wd (offset by base, since
+    # the kernel allocates wds in increasing order), with str name components
+    # interned, so that no per-watch Python objects are needed other than the
+    # name and the entry in its parent’s children. Roots are also indexed by
+    # normalized pathname, both in a dict and in a sorted list for prefix
+    # searches.
+
+    __slots__ = \
+        (
+            "base", # wd corresponding to index 0 in the arrays
+            "parents", # wd of parent, -1 for a root, ABSENT if no node
+            "masks",
+            "flags",
+            "names",
+            "count",
+            "nr_trees",
+            "children", # only for nodes that have any
+            "roots", # normalized pathname => wd
+            "root_paths", # sorted keys of roots
+            "version", # incremented on every change
+        )
+
+    ABSENT = -2
+    TREE = 1 # flag for node whose new subdirectories are to be watched as well
+
+    def __init__(self) :
+        self.children = {}
+        self.roots = {}
+        self.root_paths = []
+        self.version = 0
+        self.nr_trees = 0
+        self._reset(0)
+    #end __init__
+
+    def _reset(self, base) :
+        # empties the arrays.
+        self.base = base
+        self.parents = array.array("i")
+        self.masks = array.array("I")
+        self.flags = array.array("B")
+        self.names = []
+        self.count = 0
+    #end _reset
+
+    def __contains__(self, wd) :
+        i = wd - self.base
+        return \
+            0 <= i < len(self.parents) and self.parents[i] != self.ABSENT
+    #end __contains__
+
+    def __len__(self) :
+        return \
+            self.count
+    #end __len__
+
+    def wds(self) :
+        "iterates over the wds of all nodes."
+        base = self.base
+        ABSENT = self.ABSENT
+        for i, parent in enumerate(self.parents) :
+            if parent != ABSENT :
+                yield base + i
+            #end if
+        #end for
+    #end wds
+
+    def _parent(self, wd) :
+        return \
+            self.parents[wd - self.base]
+    #end _parent
+
+    def _name(self, wd) :
+        return \
+            self.names[wd - self.base]
+    #end _name
+
+    def mask(self, wd) :
+        return \
+            self.masks[wd - self.base]
+    #end mask
+
+    def set_mask(self, wd, mask) :
+        self.masks[wd - self.base] = mask
+    #end set_mask
+
+    def is_tree(self, wd) :
+        "is wd a node whose new subdirectories are to be watched as well."
+        i = wd - self.base
+        return \
+            0 <= i < len(self.flags) and self.flags[i] & self.TREE != 0
+    #end is_tree
+
+    def _attach(self, wd, parent, name) :
+        # sets the parent and name of wd and enters it in its parent’s
+        # children, or in the index of roots.
+        if isinstance(name, str) :
+            name = sys.intern(name)
+        #end if
+        i = wd - self.base
+        self.parents[i] = parent
+        self.names[i] = name
+        if parent >= 0 :
+            siblings = self.children.setdefault(parent, {})
+            other = siblings.get(name)
+            if other != None and other != wd :
+                self._displace(other)
+            #end if
+            siblings[name] = wd
+        else :
+            key = os.path.normpath(name)
+            other = self.roots.get(key)
+            if other == None :
+                bisect.insort(self.root_paths, key)
+            #end if
+            # (any other root of that name is displaced just by overwriting)
+            self.roots[key] = wd
+        #end if
+        self.version += 1
+    #end _attach
+
+    def _displace(self, wd) :
+        # called when another node takes the name of wd, as when a directory
+        # is deleted and recreated, or renamed over, before the IN.IGNORED for
+        # the old one is seen: makes wd a root under its full pathname, but
+        # without entering it in the index of roots, so that it can still be
+        # removed in due course.
+        pathname = self.path(wd)
+        i = wd - self.base
+        self.parents[i] = -1
+        self.names[i] = pathname
+    #end _displace
+
+    def _detach(self, wd) :
+        # removes wd from its parent’s children, or from the index of roots,
+        # unless it has been displaced from there by another node.
+        parent = self._parent(wd)
+        if parent >= 0 :
+            siblings = self.children.get(parent)
+            name = self._name(wd)
+            if siblings != None and siblings.get(name) == wd :
+                del siblings[name]
+                if len(siblings) == 0 :
+                    del self.children[parent]
+                #end if
+            #end if
+        else :
+            key = os.path.normpath(self._name(wd))
+            if self.roots.get(key) == wd :
+                del self.roots[key]
+                del self.root_paths[bisect.bisect_left(self.root_paths, key)]
+            #end if
+        #end if
+        self.version += 1
+    #end _detach
+
+    def add(self, wd, name, parent = -1, mask = 0, tree = False) :
+        "adds a node, or updates its mask and tree flag if it is already present." \
+        " A node already present within a tree stays where it is."
+        if wd not in self :
+            if self.count == 0 :
+                self._reset(wd)
+            #end if
+            i = wd - self.base
+            if i < 0 :
+                # make room at start
+                self.parents[0:0] = array.array("i", [self.ABSENT]) * -i
+                self.masks[0:0] = array.array("I", [0]) * -i
+                self.flags[0:0] = array.array("B", [0]) * -i
+                self.names[0:0] = [None] * -i
+                self.base = wd
+                i = 0
+            elif i >= len(self.parents) :
+                # make room at end
+                extra = i + 1 - len(self.parents)
+                self.parents.extend(array.array("i", [self.ABSENT]) * extra)
+                self.masks.extend(array.array("I", [0]) * extra)
+                self.flags.extend(array.array("B", [0]) * extra)
+                self.names.extend([None] * extra)
+            #end if
+            self.count += 1
+            self._attach(wd, parent, name)
+        elif self._parent(wd) < 0 and parent >= 0 :
+            self._detach(wd)
+            self._attach(wd, parent, name)
+        #end if
+        self.masks[wd - self.base] = mask
+        if tree :
+            self.mark_tree(wd)
+        #end if
+    #end add
+
+    def mark_tree(self, wd) :
+        "marks wd as a node whose new subdirectories are to be watched as well."
+        i = wd - self.base
+        if self.flags[i] & self.TREE == 0 :
+            self.flags[i] |= self.TREE
+            self.nr_trees += 1
+        #end if
+    #end mark_tree
+
+    def remove(self, wd) :
+        "removes a node; any children become roots."
+        base = self.path(wd)
+        self._detach(wd)
+        i = wd - self.base
+        if self.flags[i] & self.TREE != 0 :
+            self.nr_trees -= 1
+        #end if
+        self.parents[i] = self.ABSENT
+        self.masks[i] = 0
+        self.flags[i] = 0
+        self.names[i] = None
+        self.count -= 1
+        for name, child in self.children.pop(wd, {}).items() :
+            self._attach(child, -1, os.path.join(base, name))
+        #end for
+        if self.count == 0 :
+            self._reset(0)
+        else :
+            # trim unused space at either end
+            end = len(self.parents)
+            while self.parents[end - 1] == self.ABSENT :
+                end -= 1
+            #end while
+            start = 0
+            while self.parents[start] == self.ABSENT :
+                start += 1
+            #end while
+            if end != len(self.parents) :
+                del self.parents[end:]
+                del self.masks[end:]
+                del self.flags[end:]
+                del self.names[end:]
+            #end if
+            if start != 0 :
+                del self.parents[:start]
+                del self.masks[:start]
+                del self.flags[:start]
+                del self.names[:start]
+                self.base += start
+            #end if
+        #end if
+    #end remove
+
+    def move(self, wd, parent, name) :
+        "moves a node, and implicitly everything beneath it, to a new name under" \
+        " a new parent."
+        self._detach(wd)
+        self._attach(wd, parent, name)
+    #end move
+
+    def path(self, wd) :
+        "returns the full pathname for a node."
+        parts = []
+        while wd >= 0 :
+            i = wd - self.base
+            parts.append(self.names[i])
+            wd = self.parents[i]
+        #end while
+        parts.reverse()
+        return \
+            os.path.join(*parts)
+    #end path
+
+    def child(self, wd, name) :
+        "returns the wd of the child of wd with the given name, or None."
+        children = self.children.get(wd)
+        return \
+            (lambda : None, lambda : children.get(name))[children != None]()
+    #end child
+
+    def descendants(self, wd) :
+        "returns a list of the wds of all the nodes beneath wd, each one after" \
+        " its parent."
+        result = []
+        to_do = [wd]
+        while len(to_do) != 0 :
+            children = self.children.get(to_do.pop())
+            if children != None :
+                result.extend(children.values())
+                to_do.extend(children.values())
+            #end if
+        #end while
+        return \
+            result
+    #end descendants
+
+    def lookup(self, pathname) :
+        "returns the wd of the node for pathname, or None. Takes time proportional" \
+        " to the depth of pathname below the nearest root."
+        pathname = os.path.normpath(pathname)
+        components = []
+        while True :
+            wd = self.roots.get(pathname)
+            if wd != None :
+                break
+            #end if
+            head, tail = os.path.split(pathname)
+            if len(tail) == 0 or head == pathname :
+                break
+            #end if
+            components.append(tail)
+            pathname = head
+        #end while
+        while wd != None and len(components) != 0 :
+            wd = self.child(wd, components.pop())
+        #end while
+        return \
+            wd
+    #end lookup
+
+    def under(self, pathname) :
+        "returns a list of the wds of all nodes whose paths are pathname or lie" \
+        " beneath it. Takes time proportional to the number of nodes found, plus" \
+        " a logarithmic search of the roots."
+        result = []
+        wd = self.lookup(pathname)
+        if wd != None :
+            result.append(wd)
+            result.extend(self.descendants(wd))
+        #end if
+        prefix = os.path.join(os.path.normpath(pathname), pathname[:0])
+        root_paths = self.root_paths
+        i = bisect.bisect_left(root_paths, prefix)
+        while i < len(root_paths) and root_paths[i].startswith(prefix) :
+            root = self.roots[root_paths[i]]
+            if root != wd :
+                result.append(root)
+                result.extend(self.descendants(root))
+            #end if
+            i += 1
+        #end while
+        return \
+            result
+    #end under
+
+#end _WatchTable
+
+def _add_watches(fd, c_pathnames, mask) :
+    # adds watches with the same mask for each of the encoded pathnames on
+    # inotify instance fd, returning a list of (wd, errno) pairs. Does not
+    # touch any Python-level state, so it can be run on another thread.
+    add_watch = libc.inotify_add_watch
+    get_errno = ct.get_errno
+    result = []
+    for c_pathname in c_pathnames :
+        wd = add_watch(fd, c_pathname, mask)
+        result.append((wd, (lambda : 0, get_errno)[wd < 0]()))
+    #end for
+    return \
+        result
+#end _add_watches
+
+def _snapshot_dir(pathname) :
+    # returns a tuple of the mtime_ns of the directory pathname and a dict
+    # mapping the name (as bytes) of each entry within it to a tuple of
+    # (inode, size, mtime_ns, is directory). Returns None if pathname is not
+    # an accessible directory.
+    c_pathname = os.fsencode(pathname)
+    try :
+        dir_mtime = os.stat(c_pathname).st_mtime_ns
+        entries = {}
+        with os.scandir(c_pathname) as scan :
+            for entry in scan :
+                try :
+                    info = entry.stat(follow_symlinks = False)
+                    entries[entry.name] = \
+                        (
+                            info.st_ino,
+                            info.st_size,
+                            info.st_mtime_ns,
+                            entry.is_dir(follow_symlinks = False),
+                        )
+                except OSError :
+                    # vanished in the meantime
+                    pass
+                #end try
+            #end for
+        #end with
+        result = (dir_mtime, entries)
+    except OSError :
+        result = None
+    #end try
+    return \
+        result
+#end _snapshot_dir
+
+def _diff_entries(wd, old_entries, new_entries, watch_mask) :
+    # compares two sets of directory entries as returned by _snapshot_dir()
+    # for the directory watched by wd, and returns records for events that
+    # would account for the differences, limited to those in watch_mask. An
+    # old entry with None in place of its inode counts as possibly modified.
+    result = []
+    for name, entry in new_entries.items() :
+        isdir = (0, IN.ISDIR)[entry[3]]
+        prev = old_entries.get(name)
+        if prev == None :
+            changes = (IN.CREATE,)
+        elif prev[0] == None :
+            # seen since last scan, may have changed since
+            changes = ((IN.MODIFY,), ())[entry[3]]
+        elif prev[0] != entry[0] :
+            # replaced by a different file
+            changes = (IN.DELETE, IN.CREATE)
+        elif prev[1:3] != entry[1:3] and not entry[3] :
+            changes = (IN.MODIFY,)
+        else :
+            changes = ()
+        #end if
+        for change in changes :
+            if change & watch_mask != 0 :
+                result.append((wd, change | isdir, 0, name))
+            #end if
+        #end for
+    #end for
+    if IN.DELETE & watch_mask != 0 :
+        for name, entry in old_entries.items() :
+            if name not in new_entries :
+                result.append((wd, IN.DELETE | (0, IN.ISDIR)[entry[3]], 0, name))
+            #end if
+        #end for
+    #end if
+    return \
+        result
+#end _diff_entries
+
+_DIGEST_SIZE = 16
+_DIGEST_MOD = 1 << 8 * _DIGEST_SIZE
+_digest_entry_struct = struct.Struct("<QqqB")
+
+def _entry_digest(name, entry) :
+    # returns the digest, as an integer, of a directory entry called name (bytes)
+    # with attributes entry as from _snapshot_dir(). The digest of a directory
+    # is the sum of those of its entries and of its subdirectories, so that it
+    # does not depend on their order. The size and mtime of a subdirectory are
+    # left out, since they can change without an event in its parent, and its
+    # contents are covered by its own digest if it is being watched.
+    if entry[3] :
+        entry = (entry[0], 0, 0, True)
+    #end if
+    return \
+        int.from_bytes \
+          (
+            hashlib.sha1(b"e" + _digest_entry_struct.pack(*entry) + name).digest()[:_DIGEST_SIZE],
+            "little"
+          )
+#end _entry_digest
+
+def _subtree_digest(name, total) :
+    # returns the contribution, as an integer, of a subdirectory called name
+    # (bytes) whose own digest is total to the digest of its parent.
+    return \
+        int.from_bytes \
+          (
+            hashlib.sha1(b"d" + total.to_bytes(_DIGEST_SIZE, "little") + name).digest()[:_DIGEST_SIZE],
+            "little"
+          )
+#end _subtree_digest
+
 class Watch :
     "represents a file path being watched. Do not create directly; get from Watcher.watch()."
 
-    __slots__ = ("__weakref__", "_parent", "pathname", "mask", "wd") # to forestall typos
+    __slots__ = ("__weakref__", "_parent", "_pathname", "_mask", "wd") # to forestall typos
 
     _instances = WeakValueDictionary()
 
     def __new__(celf, wd, _parent) :
         self = celf._instances.get((wd, _parent.fd))
-        if self == None :
+        if self == None or self._parent == None or self._parent() != _parent :
+            # (a leftover object may be from a previous watch with the same wd,
+            # or from a previous Watcher with the same fd)
             self = super().__new__(celf)
             self.wd = wd
             self._parent = weak_ref(_parent)
+            self._pathname = None # only set once no longer in parent’s table
+            self._mask = 0 # ditto
             celf._instances[(wd, _parent.fd)] = self
         #end if
-        # pathname, mask set by parent
-        _parent._watches[wd] = self
         return \
             self
     #end __new__
 
     def __del__(self) :
-        self.remove()
+        parent = (lambda : None, lambda : self._parent())[self._parent != None]()
+        if parent == None or not parent._compact :
+            # (with compact_watches, Watch objects are only views, and the
+            # watch lives on in the table)
+            self.remove()
+        #end if
     #end __del__
 
+    def _table(self) :
+        # returns the parent’s watch table if I am still in it, else None.
+        parent = (lambda : None, lambda : self._parent())[self._parent != None]()
+        if parent != None and self.wd != None and self.wd in parent._tree :
+            result = parent._tree
+        else :
+            result = None
+        #end if
+        return \
+            result
+    #end _table
+
+    @property
+    def pathname(self) :
+        "the full pathname being watched. For a watch within a tree set up by" \
+        " Watcher.watch_tree(), this is derived from the current names of the" \
+        " directories above it, so it stays correct when any of them is renamed" \
+        " within the tree."
+        table = self._table()
+        if table != None :
+            result = table.path(self.wd)
+        else :
+            result = self._pathname
+        #end if
+        return \
+            result
+    #end pathname
+
+    @property
+    def mask(self) :
+        "the mask of events being watched for."
+        table = self._table()
+        if table != None :
+            result = table.mask(self.wd)
+        else :
+            result = self._mask
+        #end if
+        return \
+            result
+    #end mask
+
     @property
     def valid(self) :
         "is this Watch object still valid. It can become invalid after a" \
@@ -209,7 +1083,7 @@ class Watch :
             parent = self._parent()
             if parent != None :
                 libc.inotify_rm_watch(parent.fd, self.wd) # ignoring any error
-                parent._watches.pop(self.wd, None)
+                parent._drop_watch(self.wd)
             #end if
             self.wd = None
         #end if
@@ -219,14 +1093,14 @@ class Watch :
         "lets you change the mask associated with this Watch."
         parent = self._parent()
         assert parent != None, "parent has gone away"
-        wd = libc.inotify_add_watch(parent.fd, self.pathname.encode(), mask)
+        wd = libc.inotify_add_watch(parent.fd, os.fsencode(self.pathname), mask)
         if wd < 0 :
             errno = ct.get_errno()
             raise OSError(errno, os.strerror(errno))
         elif wd != self.wd :
             raise RuntimeError("inconsistency in watch descriptors")
         #end if
-        self.mask = mask
+        parent._tree.set_mask(wd, mask)
     #end replace_mask
 
     def __repr__(self) :
@@ -251,15 +1125,56 @@ class Watch :
 class Event :
     "represents a watch event. Do not instantiate directly; get from Watcher.get()."
 
-    __slots__ = ("watch", "mask", "cookie", "pathname") # to forestall typos
+    __slots__ = ("watch", "mask", "cookie", "pathname_bytes", "_pathname", "_fullpath") # to forestall typos
 
-    def __init__(self, watch, mask, cookie, pathname) :
+    def __init__(self, watch, mask, cookie, pathname_bytes, pathname = None) :
         self.watch = watch
         self.mask = mask
         self.cookie = cookie
-        self.pathname = pathname
+        self.pathname_bytes = pathname_bytes
+        self._pathname = pathname
+        self._fullpath = None
     #end __init
 
+    @property
+    def pathname(self) :
+        "the name of the affected file within the watched directory, or empty" \
+        " if the event applies to the watched object itself. This is decoded" \
+        " from pathname_bytes on first access, with undecodable bytes turned" \
+        " into surrogate escapes as per os.fsdecode(). For a Watcher created" \
+        " with bytes_paths = True, it is the same as pathname_bytes."
+        if self._pathname == None :
+            self._pathname = os.fsdecode(self.pathname_bytes)
+        #end if
+        return \
+            self._pathname
+    #end pathname
+
+    @property
+    def fullpath(self) :
+        "the full pathname of the affected file, i.e. the pathname of the watch" \
+        " joined with pathname, or None if the event has no watch. While the" \
+        " watch is current, this comes from a bounded cache in the Watcher keyed" \
+        " on watch and name, so repeated events for the same file share the same" \
+        " string objects, with the name component interned."
+        if self._fullpath == None and self.watch != None :
+            table = self.watch._table()
+            if table != None :
+                name, self._fullpath = \
+                    self.watch._parent()._fullpath_for(self.watch.wd, self.pathname_bytes)
+                if self._pathname == None :
+                    self._pathname = name
+                #end if
+            elif len(self.pathname_bytes) != 0 :
+                self._fullpath = os.path.join(self.watch.pathname, self.pathname)
+            else :
+                self._fullpath = self.watch.pathname
+            #end if
+        #end if
+        return \
+            self._fullpath
+    #end fullpath
+
     def __repr__(self) :
         return \
             (
@@ -289,156 +1204,2818 @@ class STOP_ON(enum.Enum) :
     #CLOSED = 2 # can I implement this?
 #end STOP_ON
 
-class Watcher :
-    "a context for watching one or more files or directories. Do not instantiate directly;" \
-    " use the create() method."
+@enum.unique
+class OVERFLOW(enum.Enum) :
+    "policies for when the queue of pending events in a Watcher reaches its" \
+    " max_pending limit:\n" \
+    "\n" \
+    "    BLOCK - stop reading from the kernel until the queue drains down to\n" \
+    "        low_water, leaving the kernel queue to absorb the burst\n" \
+    "    DROP_OLDEST - discard the oldest queued event to make room\n" \
+    "    DROP_NEWEST - discard the incoming event\n" \
+    "    COALESCE - merge the incoming event’s mask into an already-queued event\n" \
+    "        for the same watch and name if there is one, else discard it"
+    BLOCK = 1
+    DROP_OLDEST = 2
+    DROP_NEWEST = 3
+    COALESCE = 4
+#end OVERFLOW
 
-    __slots__ = \
-        ( # to forestall typos
-            "__weakref__",
-            "fd",
-            "_watches",
-            "_loop",
-            "_reader_count",
-            "_awaiting",
-            "_notifs",
-        )
+TreeEstimate = namedtuple("TreeEstimate", ("nr_watches", "nr_available"))
+TreeEstimate.__doc__ = \
+    "result of Watcher.estimate_tree(): the number of watches that watch_tree()" \
+    " would need, and the number available, or None if that is not known."
 
-    _instances = WeakValueDictionary()
+class TreeSetup(namedtuple("TreeSetup", ("watch", "nr_watches", "elapsed"))) :
+    "result of Watcher.watch_tree(): the Watch for the top of the tree, the" \
+    " number of watches added, and the time taken in seconds."
 
-    def __new__(celf, fd) :
-        self = celf._instances.get(fd)
-        if self == None :
-            self = super().__new__(celf)
-            self.fd = fd
-            self._loop = None # to begin with
-            self._watches = {}
-            self._reader_count = 0
-            self._awaiting = []
-            self._notifs = []
-            celf._instances[fd] = self
-        #end if
+    __slots__ = ()
+
+    @property
+    def rate(self) :
+        "watches added per second."
         return \
-            self
-    #end __new__
+            self.nr_watches / max(self.elapsed, 1e-9)
+    #end rate
 
-    def _add_remove_watch(self, add) :
-        loop = self._loop()
-        if add :
-            assert loop != None, "loop has gone away"
-            loop.add_reader(self.fd, self._callback)
-        else :
-            if loop != None :
-                loop.remove_reader(self.fd)
-            #end if
-        #end if
-    #end _add_remove_watch
+#end TreeSetup
+
+OverflowRecovery = namedtuple("OverflowRecovery", ("nr_scanned", "nr_skipped", "nr_events", "elapsed"))
+OverflowRecovery.__doc__ = \
+    "statistics for the last recovery from IN.Q_OVERFLOW by a Watcher created" \
+    " with recover_overflow = True: the number of directories rescanned, the" \
+    " number skipped because their mtime had not changed, the number of events" \
+    " synthesized, and the time taken in seconds."
+
+BulkWatchResult = namedtuple("BulkWatchResult", ("watches", "errors"))
+BulkWatchResult.__doc__ = \
+    "result of Watcher.watch_many(): the list of Watch objects for the paths" \
+    " successfully watched, and a list of (pathname, OSError) pairs for those" \
+    " that could not be."
+
+class TreeSnapshot :
+    "the state of a set of directories as saved by Watcher.save_snapshot(), for" \
+    " passing to Watcher.watch_tree() on restart. Do not instantiate directly;" \
+    " use the load() method. The file is memory-mapped, and only an index of" \
+    " directories is built on loading; the entries of a directory are only" \
+    " decoded if it turns out to have changed. If saved from a Watcher created" \
+    " with digest_index = True, it also holds the digest of each directory, for" \
+    " passing to Watcher.compare_trees()."
+
+    __slots__ = ("_map", "_index", "_flags") # to forestall typos
+
+    MAGIC = b"INOTSNAP"
+    VERSION = 2
+    HAS_DIGESTS = 1 # flag
+    _header = struct.Struct("<8sIII") # magic, version, nr dirs, flags
+    _dir_header = struct.Struct("<qIII%ds%ds" % (_DIGEST_SIZE, _DIGEST_SIZE))
+      # dir mtime, pathname len, nr entries, entries len, digest of entries, digest of subtree
+    _entry = struct.Struct("<QqqBH") # inode, size, mtime, is dir, name len
+
+    def __init__(self, mapped, index, flags) :
+        self._map = mapped
+        self._index = index
+        self._flags = flags
+    #end __init__
 
     @classmethod
-    def create(celf, flags = 0, loop = None) :
-        "creates a new Watcher for collecting filesystem notifications. loop is the" \
-        " asyncio event loop into which to install reader callbacks; the default" \
-        " loop is used if this not specified."
-        if loop == None :
-            loop = asyncio.get_event_loop()
+    def load(celf, filename) :
+        "loads a snapshot from the specified file."
+        with open(filename, "rb") as infile :
+            mapped = mmap.mmap(infile.fileno(), 0, access = mmap.ACCESS_READ)
+        #end with
+        magic, version, nr_dirs, flags = celf._header.unpack_from(mapped, 0)
+        if magic != celf.MAGIC or version != celf.VERSION :
+            mapped.close()
+            raise ValueError("%s is not a snapshot file" % filename)
         #end if
-        fd = libc.inotify_init1(flags)
-        if fd < 0 :
-            errno = ct.get_errno()
-            raise OSError(errno, os.strerror(errno))
+        index = {}
+        pos = celf._header.size
+        dir_header = celf._dir_header
+        for i in range(nr_dirs) :
+            dir_mtime, path_len, nr_entries, entries_len, local, total = \
+                dir_header.unpack_from(mapped, pos)
+            pos += dir_header.size
+            index[mapped[pos : pos + path_len]] = \
+                (dir_mtime, pos + path_len, nr_entries, local, total)
+            pos += path_len + entries_len
+        #end for
+        return \
+            celf(mapped, index, flags)
+    #end load
+
+    @classmethod
+    def _save(celf, filename, dirs, has_digests) :
+        # writes a snapshot file from dirs, an iterable of (pathname,
+        # (dir_mtime, entries), digests) with the second as from _snapshot_dir(),
+        # and digests a pair of integers, the digest of the entries and of the
+        # whole subtree, or None if not has_digests. The file is written under a
+        # temporary name and then renamed, so it is replaced atomically.
+        tempname = filename + ".tmp"
+        nr_dirs = 0
+        flags = (0, celf.HAS_DIGESTS)[has_digests]
+        entry = celf._entry
+        with open(tempname, "wb") as outfile :
+            outfile.write(celf._header.pack(celf.MAGIC, celf.VERSION, 0, flags))
+            for pathname, (dir_mtime, entries), digests in dirs :
+                pathname = celf._key(pathname)
+                data = bytearray()
+                for name, (ino, size, mtime, isdir) in entries.items() :
+                    data.extend(entry.pack(ino, size, mtime, isdir, len(name)))
+                    data.extend(name)
+                #end for
+                if digests == None :
+                    digests = (0, 0)
+                #end if
+                outfile.write \
+                  (
+                    celf._dir_header.pack
+                      (
+                        dir_mtime,
+                        len(pathname),
+                        len(entries),
+                        len(data),
+                        digests[0].to_bytes(_DIGEST_SIZE, "little"),
+                        digests[1].to_bytes(_DIGEST_SIZE, "little"),
+                      )
+                  )
+                outfile.write(pathname)
+                outfile.write(data)
+                nr_dirs += 1
+            #end for
+            outfile.seek(0)
+            outfile.write(celf._header.pack(celf.MAGIC, celf.VERSION, nr_dirs, flags))
+        #end with
+        os.replace(tempname, filename)
+    #end _save
+
+    @staticmethod
+    def _key(pathname) :
+        return \
+            os.path.normpath(os.fsencode(pathname))
+    #end _key
+
+    def __len__(self) :
+        return \
+            len(self._index)
+    #end __len__
+
+    def __contains__(self, pathname) :
+        return \
+            self._key(pathname) in self._index
+    #end __contains__
+
+    def dir_mtime(self, pathname) :
+        "returns the saved mtime_ns of the directory pathname, or None if it" \
+        " is not in the snapshot."
+        info = self._index.get(self._key(pathname))
+        return \
+            (lambda : None, lambda : info[0])[info != None]()
+    #end dir_mtime
+
+    def entries(self, pathname) :
+        "returns a dict mapping the name (as bytes) of each entry saved for the" \
+        " directory pathname to a tuple of (inode, size, mtime_ns, is directory)," \
+        " or None if the directory is not in the snapshot."
+        info = self._index.get(self._key(pathname))
+        if info != None :
+            dir_mtime, pos, nr_entries = info[:3]
+            mapped = self._map
+            unpack_from = self._entry.unpack_from
+            entry_size = self._entry.size
+            result = {}
+            for i in range(nr_entries) :
+                ino, size, mtime, isdir, name_len = unpack_from(mapped, pos)
+                pos += entry_size
+                result[mapped[pos : pos + name_len]] = (ino, size, mtime, isdir != 0)
+                pos += name_len
+            #end for
+        else :
+            result = None
+        #end if
+        return \
+            result
+    #end entries
+
+    def _digest_pair(self, pathname) :
+        # returns the pair of integers (digest of entries, digest of subtree)
+        # saved for the directory pathname, or None if it is not in the
+        # snapshot. Raises ValueError if no digests were saved.
+        if self._flags & self.HAS_DIGESTS == 0 :
+            raise ValueError("snapshot was saved without digests")
+        #end if
+        info = self._index.get(self._key(pathname))
+        return \
+            (
+                lambda : None,
+                lambda : (int.from_bytes(info[3], "little"), int.from_bytes(info[4], "little")),
+            )[info != None]()
+    #end _digest_pair
+
+    def digest(self, pathname) :
+        "returns the digest saved for the directory pathname and everything" \
+        " beneath it, or None if it is not in the snapshot."
+        digests = self._digest_pair(pathname)
+        return \
+            (lambda : None, lambda : digests[1].to_bytes(_DIGEST_SIZE, "little"))[digests != None]()
+    #end digest
+
+    def close(self) :
+        "releases the mapping of the file."
+        if self._map != None :
+            self._map.close()
+            self._map = None
+        #end if
+    #end close
+
+#end TreeSnapshot
+
+def _poll_watcher(w_watcher) :
+    # timer callback for the polling tier of a Watcher, holding only a weak
+    # reference so as not to keep it alive.
+    watcher = w_watcher()
+    if watcher != None :
+        watcher._poll()
+    #end if
+#end _poll_watcher
+
+class _ReaderThread :
+    # background thread for a Watcher created with reader_thread = True. It
+    # blocks in poll() on the inotify fd, reads until the kernel queue is
+    # empty, and hands the parsed records to the event loop as one batch,
+    # so the kernel queue keeps being drained while the loop is busy. It
+    # only holds a weak reference to the Watcher, so as not to keep it alive.
+
+    __slots__ = \
+        (
+            "fd",
+            "loop",
+            "w_watcher",
+            "running",
+            "stopping",
+            "wake_r",
+            "wake_w",
+            "thread",
+        )
+
+    def __init__(self, watcher, loop) :
+        self.fd = watcher.fd
+        self.loop = loop
+        self.w_watcher = weak_ref(watcher)
+        self.running = threading.Event()
+        self.stopping = False
+        self.wake_r, self.wake_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+        self.thread = threading.Thread(target = self.run, name = "inotify reader", daemon = True)
+        self.thread.start()
+    #end __init__
+
+    def _wake(self) :
+        # interrupts the poll() so the thread notices a change of state.
+        try :
+            os.write(self.wake_w, b"\0")
+        except BlockingIOError :
+            pass
+        #end try
+    #end _wake
+
+    def set_running(self, running) :
+        "starts or stops reading, as for adding or removing a reader callback."
+        if running :
+            self.running.set()
+        else :
+            self.running.clear()
+            self._wake()
+        #end if
+    #end set_running
+
+    def stop(self) :
+        "makes the thread exit, and waits for it to do so."
+        self.stopping = True
+        self.running.set()
+        self._wake()
+        if self.thread != threading.current_thread() :
+            self.thread.join()
+        #end if
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+    #end stop
+
+    def run(self) :
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        poller.register(self.wake_r, select.POLLIN)
+        buf = bytearray()
+        min_size = ct.sizeof(inotify_event) + NAME_MAX + 1
+        while True :
+            self.running.wait()
+            if self.stopping :
+                break
+            #end if
+            ready = set(fd for fd, events in poller.poll())
+            if self.stopping :
+                break
+            #end if
+            if self.wake_r in ready :
+                os.read(self.wake_r, 64)
+                continue
+            #end if
+            records = []
+            nr_reads = 0
+            pending = _pending_bytes(self.fd)
+            while pending != 0 :
+                size = min(max(pending, min_size), READ_BUFSIZE_MAX)
+                if len(buf) < size :
+                    buf = bytearray(size)
+                #end if
+                try :
+                    nbytes = os.readv(self.fd, [buf])
+                except BlockingIOError :
+                    break
+                #end try
+                nr_reads += 1
+                records.extend(_parse_events(buf, nbytes))
+                pending = _pending_bytes(self.fd)
+            #end while
+            if len(records) != 0 :
+                try :
+                    self.loop.call_soon_threadsafe(_reader_thread_batch, self.w_watcher, records, nr_reads)
+                except RuntimeError :
+                    # loop has been closed
+                    break
+                #end try
+            #end if
+        #end while
+    #end run
+
+#end _ReaderThread
+
+def _reader_thread_batch(w_watcher, records, nr_reads) :
+    # loop callback for a batch of records from a _ReaderThread.
+    watcher = w_watcher()
+    if watcher != None :
+        watcher._thread_batch(records, nr_reads)
+    #end if
+#end _reader_thread_batch
+
+def _check_stop_on(stop_on) :
+    # common validation of stop_on arg to Watcher.iter_async and iter_batches.
+    if stop_on == None :
+        stop_on = frozenset()
+    elif (
+            not isinstance(stop_on, (set, frozenset))
+        or
+            not all(isinstance(elt, STOP_ON) for elt in stop_on)
+    ) :
+        raise TypeError("stop_on must be None or set of STOP_ON")
+    #end if
+    return \
+        stop_on
+#end _check_stop_on
+
+class Watcher :
+    "a context for watching one or more files or directories. Do not instantiate directly;" \
+    " use the create() method."
+
+    __slots__ = \
+        ( # to forestall typos
+            "__weakref__",
+            "fd",
+            "_watches",
+            "_loop",
+            "_reader_count",
+            "_reader_installed",
+            "_persistent",
+            "_paused",
+            "_blocked",
+            "_max_pending",
+            "_low_water",
+            "_overflow",
+            "_above_high",
+            "_coalesce",
+            "_on_high_water",
+            "_on_low_water",
+            "_awaiting",
+            "_nr_stale_waiters",
+            "_notifs",
+            "_zombies",
+            "_tree",
+            "_sorted_watches",
+            "_fullpaths",
+            "_fullpaths_version",
+            "_compact",
+            "_moves",
+            "_snapshots",
+            "_digests",
+            "_budget",
+            "_activity",
+            "_evicted",
+            "_evicted_gone",
+            "_releases",
+            "_polled",
+            "_poll_interval",
+            "_poll_handle",
+            "_bufsize",
+            "_buf",
+            "_bytes_paths",
+            "_raw_handler",
+            "_raw_batch",
+            "_raw_columnar",
+            "_merged",
+            "_reader_thread",
+            "_group",
+            # statistics, readable by caller:
+            "nr_wakeups",
+            "nr_reads",
+            "nr_events",
+            "last_wakeup_events",
+            "nr_reader_changes",
+            "nr_dropped",
+            "last_recovery",
+            "nr_evictions",
+            "nr_restores",
+        )
+
+    _instances = WeakValueDictionary()
+
+    def __new__(celf, fd) :
+        self = celf._instances.get(fd)
+        if self == None :
+            self = super().__new__(celf)
+            self.fd = fd
+            self._loop = None # to begin with
+            self._watches = {}
+            self._reader_count = 0
+            self._reader_installed = False
+            self._persistent = False
+            self._paused = False
+            self._blocked = False
+            self._max_pending = None
+            self._low_water = None
+            self._overflow = OVERFLOW.BLOCK
+            self._above_high = False
+            self._coalesce = None
+            self._on_high_water = None
+            self._on_low_water = None
+            self._awaiting = deque()
+            self._nr_stale_waiters = 0
+            self._notifs = _EventQueue()
+            self._zombies = {}
+            self._tree = _WatchTable()
+            self._sorted_watches = None
+            self._fullpaths = OrderedDict()
+            self._fullpaths_version = None
+            self._compact = False
+            self._moves = {}
+            self._snapshots = None
+            self._digests = None
+            self._budget = None
+            self._activity = OrderedDict()
+            self._evicted = set()
+            self._evicted_gone = []
+            self._releases = deque()
+            self._polled = {}
+            self._poll_interval = None
+            self._poll_handle = None
+            self._bufsize = None
+            self._buf = bytearray()
+            self._bytes_paths = False
+            self._raw_handler = None
+            self._raw_batch = False
+            self._raw_columnar = False
+            self._merged = None
+            self._reader_thread = None
+            self._group = None
+            self.nr_wakeups = 0
+            self.nr_reads = 0
+            self.nr_events = 0
+            self.last_wakeup_events = 0
+            self.nr_reader_changes = 0
+            self.nr_dropped = dict((k, 0) for k in OVERFLOW)
+            self.last_recovery = None
+            self.nr_evictions = 0
+            self.nr_restores = 0
+            celf._instances[fd] = self
+        #end if
+        return \
+            self
+    #end __new__
+
+    def _add_remove_watch(self, add) :
+        if self._reader_thread != None :
+            self._reader_thread.set_running(add)
+            return
+        #end if
+        if self._group != None :
+            group = self._group()
+            if group != None :
+                group._set_reading(self, add)
+            #end if
+            return
+        #end if
+        loop = self._loop()
+        if add :
+            assert loop != None, "loop has gone away"
+            loop.add_reader(self.fd, self._callback)
+        else :
+            if loop != None :
+                loop.remove_reader(self.fd)
+            #end if
+        #end if
+    #end _add_remove_watch
+
+    def _update_reader(self) :
+        # installs or removes the reader callback according to whether
+        # anybody currently wants events read.
+        want = \
+            (
+                self._loop != None
+            and
+                (self._persistent or self._reader_count != 0 or self._raw_handler != None)
+            and
+                not self._paused
+            and
+                not self._blocked
+            )
+        if want != self._reader_installed :
+            self._add_remove_watch(want)
+            self._reader_installed = want
+            self.nr_reader_changes += 1
+        #end if
+    #end _update_reader
+
+    def pause(self) :
+        "stops reading events from the kernel until resume() is called. Events" \
+        " that arrive meanwhile are held in the kernel queue, which will overflow" \
+        " (reporting IN.Q_OVERFLOW) if the pause goes on too long. Events already" \
+        " read can still be retrieved with get() and friends."
+        self._paused = True
+        self._update_reader()
+    #end pause
+
+    def resume(self) :
+        "resumes reading events after a pause()."
+        self._paused = False
+        self._update_reader()
+    #end resume
+
+    @classmethod
+    def create \
+      (
+        celf,
+        flags = 0,
+        loop = None,
+        bufsize = None,
+        bytes_paths = False,
+        persistent = False,
+        max_pending = None,
+        overflow = OVERFLOW.BLOCK,
+        low_water = None,
+        compact_watches = False,
+        recover_overflow = False,
+        digest_index = False,
+        watch_budget = None,
+        poll_interval = 5.0,
+        reader_thread = False,
+        synchronous = False,
+        group = None,
+      ) :
+        "creates a new Watcher for collecting filesystem notifications. loop is the" \
+        " asyncio event loop into which to install reader callbacks; the default" \
+        " loop is used if this not specified.\n" \
+        "\n" \
+        "bufsize controls how much is read from the kernel queue at a time. If None," \
+        " each read is sized from the number of bytes the kernel reports as pending" \
+        " (FIONREAD). Otherwise it is the initial size of the read buffer in bytes" \
+        " (e.g. 65536), which is automatically grown, up to READ_BUFSIZE_MAX, if" \
+        " bursts are observed to exceed it. Either way, each wakeup keeps reading" \
+        " until the kernel queue is empty.\n" \
+        "\n" \
+        "If bytes_paths is True, pathnames are kept as bytes throughout: in" \
+        " Watch.pathname as well as Event.pathname. Otherwise they are str," \
+        " decoded as per os.fsdecode() only when Event.pathname is accessed.\n" \
+        "\n" \
+        "If persistent is True, the reader callback stays installed on the loop" \
+        " for the life of the Watcher, and events are queued as they arrive," \
+        " instead of the callback being added and removed around each wait in" \
+        " get(). Use pause() and resume() to apply backpressure.\n" \
+        "\n" \
+        "max_pending, if not None, limits the number of events held in the" \
+        " Watcher’s queue; overflow is an OVERFLOW.xxx value saying what to do" \
+        " when that limit is reached, and the count of events discarded is kept" \
+        " in nr_dropped[overflow]. IN.IGNORED and IN.Q_OVERFLOW events are never" \
+        " discarded. Under OVERFLOW.BLOCK, reading stops when the limit is" \
+        " reached, leaving further events in the kernel queue, though the" \
+        " last read may take the queue a few events past the limit. low_water" \
+        " (default max_pending // 2) is the queue length below" \
+        " which reading resumes under OVERFLOW.BLOCK; see also" \
+        " set_watermark_callbacks().\n" \
+        "\n" \
+        "If compact_watches is True, the Watcher does not keep a Watch object" \
+        " for each watch: their details are held only in its watch table, and" \
+        " Watch objects are created on demand as views onto it. Dropping such a" \
+        " Watch does not remove the watch; call remove() explicitly. This saves" \
+        " memory when watching very large numbers of directories.\n" \
+        "\n" \
+        "If recover_overflow is True, the Watcher keeps a snapshot of the entries" \
+        " (inode, size and mtime) in each watched directory, noting changes as" \
+        " events arrive. When the kernel reports IN.Q_OVERFLOW, each watched directory" \
+        " whose own mtime has changed is rescanned, and IN.CREATE, IN.DELETE and" \
+        " IN.MODIFY events are synthesized from the differences, following the" \
+        " IN.Q_OVERFLOW event; statistics for this are left in last_recovery." \
+        " Files that had events since the last scan get an IN.MODIFY, which may" \
+        " therefore duplicate one already seen. A directory is skipped if there" \
+        " have been no events for it since its last scan and its mtime is" \
+        " unchanged, so missed modifications to existing files within it are" \
+        " not detected. Taking the snapshots adds a directory scan to setting" \
+        " up each watch.\n" \
+        "\n" \
+        "If digest_index is True (which requires recover_overflow), the Watcher" \
+        " also maintains a digest for each watched directory, covering the name," \
+        " inode, size and mtime of its entries and the digests of its watched" \
+        " subdirectories; see digest() and compare_trees(). An event only marks" \
+        " the digests on the path from its directory to the root as stale, and" \
+        " just those are recomputed when next asked for.\n" \
+        "\n" \
+        "watch_budget, if not None, is the maximum number of watches to hold, for" \
+        " example max_user_watches() less a margin for other users of inotify." \
+        " When adding a watch would exceed it, the least recently active" \
+        " directories at the bottom of trees set up by watch_tree() are evicted" \
+        " to a polling tier, which checks the mtimes of its directories every" \
+        " poll_interval seconds and reports what has been added or removed" \
+        " against the nearest watched directory above, with Event.pathname" \
+        " giving the path relative to that. A polled directory that shows" \
+        " changes is watched again if the directory above it is being watched." \
+        " New directories within a tree go to the polling tier if there is no" \
+        " room for them, as do those for which the kernel reports ENOSPC. Only" \
+        " Watches set up with watch() or watch_many(), and the tops of trees," \
+        " count against the budget but are never evicted; watch() raises ENOSPC" \
+        " if no room can be made, and the watch_many methods report the paths" \
+        " they had no room for as ENOSPC errors.\n" \
+        "\n" \
+        "If reader_thread is True, instead of a reader callback on the loop, a" \
+        " background thread waits on the inotify fd, reads and decodes events as" \
+        " they arrive, and passes each batch to the loop with a single" \
+        " call_soon_threadsafe(), so that the kernel queue keeps being drained" \
+        " while the loop is busy. This implies persistent; pause() and" \
+        " OVERFLOW.BLOCK stop the thread reading. Events read while the loop is" \
+        " stalled are held in the loop’s queue of callbacks, not subject to" \
+        " max_pending, until it gets to them.\n" \
+        "\n" \
+        "If synchronous is True, no event loop is used (loop must be None), and" \
+        " events are only read from the kernel within calls to read_events() or" \
+        " iter_events(), which block the calling thread; get() and the other" \
+        " coroutines cannot be used. Raw handlers are called from within those" \
+        " calls, as is the polling tier when it is due.\n" \
+        "\n" \
+        "group, if not None, is a WatcherGroup which reads the Watcher’s fd along" \
+        " with those of its other members, instead of the Watcher having its own" \
+        " reader callback on the loop. loop defaults to the group’s loop."
+        if not isinstance(overflow, OVERFLOW) :
+            raise TypeError("overflow must be an OVERFLOW.xxx value")
+        #end if
+        if digest_index and not recover_overflow :
+            raise ValueError("digest_index requires recover_overflow")
+        #end if
+        if synchronous :
+            if loop != None or reader_thread or group != None :
+                raise ValueError("synchronous Watcher cannot have a loop, reader thread or group")
+            #end if
+        elif group != None :
+            if reader_thread :
+                raise ValueError("Watcher in a group cannot have a reader thread")
+            #end if
+            if loop == None :
+                loop = group._loop()
+            elif loop != group._loop() :
+                raise ValueError("Watcher must be on the same loop as its group")
+            #end if
+        elif loop == None :
+            loop = asyncio.get_event_loop()
+        #end if
+        if bufsize != None :
+            bufsize = max(bufsize, ct.sizeof(inotify_event) + NAME_MAX + 1)
+        #end if
+        fd = libc.inotify_init1(flags)
+        if fd < 0 :
+            errno = ct.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        #end if
+        result = celf(fd)
+        result._bufsize = bufsize
+        result._bytes_paths = bytes_paths
+        if result._loop == None :
+            if loop != None :
+                result._loop = weak_ref(loop)
+            #end if
+        elif result._loop() != loop :
+            raise RuntimeError("watcher was not created on current event loop")
+        #end if
+        result._persistent = persistent or reader_thread
+        result._compact = compact_watches
+        if recover_overflow :
+            result._snapshots = {}
+        #end if
+        if digest_index :
+            result._digests = {}
+        #end if
+        result._budget = watch_budget
+        result._poll_interval = poll_interval
+        if reader_thread and result._reader_thread == None :
+            result._reader_thread = _ReaderThread(result, loop)
+        #end if
+        if group != None :
+            result._group = weak_ref(group)
+        #end if
+        result._max_pending = max_pending
+        if max_pending != None :
+            if low_water == None :
+                low_water = max_pending // 2
+            #end if
+            result._low_water = low_water
+            result._overflow = overflow
+            if overflow == OVERFLOW.COALESCE :
+                result._coalesce = {}
+            #end if
+        #end if
+        result._update_reader()
+        return \
+            result
+    #end create
+
+    def _pathname_args(self, pathname) :
+        # returns pathname in the form it is to be recorded in a Watch, and
+        # in the form to be passed to the kernel.
+        if self._bytes_paths :
+            pathname = os.fsencode(pathname)
+            c_pathname = pathname
+        else :
+            pathname = os.fsdecode(pathname)
+            c_pathname = os.fsencode(pathname)
+        #end if
+        return \
+            pathname, c_pathname
+    #end _pathname_args
+
+    def watch(self, pathname, mask) :
+        "adds a watch for the specified path, or replaces any previous" \
+        " watch settings if there is already a watch on that path. Returns" \
+        " the Watch object, either the same one as before or a new one for a" \
+        " new path. pathname may be str or bytes; the Watch records it as bytes" \
+        " if the Watcher was created with bytes_paths = True, else as str."
+        pathname, c_pathname = self._pathname_args(pathname)
+        return \
+            self._add_watch(pathname, c_pathname, mask)
+    #end watch
+
+    async def watch_async(self, pathname, mask, executor = None) :
+        "does the same as watch(), but the kernel call, which has to look up" \
+        " pathname and may block for a while on a slow or remote filesystem, is" \
+        " made on a thread from executor (the loop’s default executor if None)" \
+        " so as not to hold up the event loop. The watch table is updated back" \
+        " on the loop thread."
+        if self._loop == None :
+            raise RuntimeError("synchronous Watcher: use watch() instead")
+        #end if
+        pathname, c_pathname = self._pathname_args(pathname)
+        loop = self._loop()
+        assert loop != None, "loop has gone away"
+        self._check_budget(pathname)
+        (wd, errno), = await loop.run_in_executor(executor, _add_watches, self.fd, [c_pathname], mask)
+        if wd < 0 :
+            raise OSError(errno, os.strerror(errno))
+        #end if
+        return \
+            self._register_watch(wd, pathname, mask)
+    #end watch_async
+
+    def _add_watch(self, pathname, c_pathname, mask, parent_wd = -1, name = None, tree = False) :
+        # common code for adding a watch on pathname (encoded as c_pathname)
+        # and entering it in the watch table, optionally as the child called
+        # name of the watch with wd parent_wd, and optionally marked as part
+        # of a tree to be extended with new subdirectories.
+        self._check_budget(pathname, parent_wd)
+        wd = libc.inotify_add_watch(self.fd, c_pathname, mask)
+        if wd < 0 :
+            errno = ct.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        #end if
+        return \
+            self._register_watch(wd, pathname, mask, parent_wd, name, tree)
+    #end _add_watch
+
+    def _check_budget(self, pathname, parent_wd = -1) :
+        # raises ENOSPC if a new watch on pathname, as a child of parent_wd
+        # if this is not -1, would exceed the watch budget and no room can be
+        # made for it. Nothing is evicted if the parent has gone already.
+        if self._budget != None and self._tree.lookup(pathname) == None :
+            if parent_wd >= 0 and parent_wd not in self._tree :
+                raise OSError(ENOSPC, os.strerror(ENOSPC))
+            #end if
+            if parent_wd in self._activity :
+                self._activity.move_to_end(parent_wd) # don’t evict it now
+            #end if
+            if self._make_room(1) == 0 or parent_wd >= 0 and parent_wd not in self._tree :
+                raise OSError(ENOSPC, os.strerror(ENOSPC))
+            #end if
+        #end if
+    #end _check_budget
+
+    def _budget_filter(self, args) :
+        # for the watch_many methods: makes what room it can within the watch
+        # budget for the (pathname, c_pathname) pairs in args, and returns a
+        # list of those there is room for, and a list of (pathname, OSError)
+        # pairs for the rest. Paths already being watched need no room.
+        lookup = self._tree.lookup
+        room = self._make_room(sum(1 for a in args if lookup(a[0]) == None))
+        allowed = []
+        refused = []
+        for a in args :
+            if lookup(a[0]) == None :
+                if room == 0 :
+                    refused.append((a[0], OSError(ENOSPC, os.strerror(ENOSPC), a[0])))
+                    continue
+                #end if
+                room -= 1
+            #end if
+            allowed.append(a)
+        #end for
+        return \
+            allowed, refused
+    #end _budget_filter
+
+    def _register_watch(self, wd, pathname, mask, parent_wd = -1, name = None, tree = False) :
+        # enters a watch just added by the kernel into the watch table, and
+        # returns the Watch object for it.
+        if parent_wd < 0 :
+            name = pathname
+        #end if
+        self._tree.add(wd, name, parent_wd, mask, tree)
+        if self._budget != None :
+            if parent_wd >= 0 :
+                self._activity[wd] = None
+            #end if
+            self._polled.pop(os.path.normpath(pathname), None)
+        #end if
+        if self._snapshots != None :
+            snapshot = _snapshot_dir(pathname)
+            if snapshot != None :
+                self._snapshots[wd] = list(snapshot)
+                if self._digests != None :
+                    self._digests[wd] = [None, None]
+                    self._stale_digest(wd)
+                #end if
+            #end if
+        #end if
+        result = self._watches.get(wd)
+        if result == None :
+            result = Watch(wd, self)
+            if not self._compact :
+                self._watches[wd] = result
+            #end if
+        #end if
+        return \
+            result
+    #end _register_watch
+
+    def _watch_for(self, wd) :
+        # returns the Watch object for wd, or None if there is no such watch.
+        result = self._watches.get(wd)
+        if result == None and self._compact and wd in self._tree :
+            result = Watch(wd, self)
+        #end if
+        return \
+            result
+    #end _watch_for
+
+    def _register_many(self, pathnames, results, mask) :
+        # common code for the watch_many methods: enters results from
+        # _add_watches into the watch table, collecting the resulting Watch
+        # objects and errors into a BulkWatchResult.
+        register = self._register_watch
+        watches = []
+        errors = []
+        for pathname, (wd, errno) in zip(pathnames, results) :
+            if wd < 0 :
+                errors.append((pathname, OSError(errno, os.strerror(errno), pathname)))
+            else :
+                watches.append(register(wd, pathname, mask))
+            #end if
+        #end for
+        return \
+            BulkWatchResult(watches, errors)
+    #end _register_many
+
+    def watch_many(self, pathnames, mask) :
+        "adds watches for all the paths in the sequence pathnames, all with the" \
+        " same mask. Unlike watch(), this does not stop at the first failure:" \
+        " it returns a BulkWatchResult giving the list of Watch objects for" \
+        " those paths that succeeded, in order, and a list of (pathname, OSError)" \
+        " pairs for those that failed (e.g. with ENOENT, EACCES or ENOSPC)."
+        args = list(map(self._pathname_args, pathnames))
+        refused = []
+        if self._budget != None :
+            args, refused = self._budget_filter(args)
+        #end if
+        result = self._register_many \
+          (
+            (a[0] for a in args),
+            _add_watches(self.fd, (a[1] for a in args), mask),
+            mask
+          )
+        return \
+            BulkWatchResult(result.watches, result.errors + refused)
+    #end watch_many
+
+    async def watch_many_async(self, pathnames, mask, chunk = 1000, offload = False, executor = None) :
+        "does the same as watch_many(), but yields to the event loop after every" \
+        " chunk paths, so that a long registration does not hold up other tasks." \
+        " If offload is True or executor is not None, the kernel calls for each" \
+        " chunk are made on a thread from executor (the loop’s default executor" \
+        " if None), so that the event loop stays responsive, and can go on" \
+        " delivering events for existing watches, even if a slow filesystem makes" \
+        " those calls block. Only one chunk is in progress at a time, so a single" \
+        " call never occupies more than one thread. The watch table is updated" \
+        " back on the loop thread."
+        if self._loop == None :
+            raise RuntimeError("synchronous Watcher: use watch_many() instead")
+        #end if
+        loop = self._loop()
+        assert loop != None, "loop has gone away"
+        offload = offload or executor != None
+        watches = []
+        errors = []
+        pathnames = iter(pathnames)
+        while True :
+            some = list(map(self._pathname_args, itertools.islice(pathnames, chunk)))
+            if len(some) == 0 :
+                break
+            #end if
+            if self._budget != None :
+                some, refused = self._budget_filter(some)
+                errors.extend(refused)
+            #end if
+            c_pathnames = [a[1] for a in some]
+            if offload :
+                results = await loop.run_in_executor(executor, _add_watches, self.fd, c_pathnames, mask)
+            else :
+                results = _add_watches(self.fd, c_pathnames, mask)
+            #end if
+            result = self._register_many((a[0] for a in some), results, mask)
+            watches.extend(result.watches)
+            errors.extend(result.errors)
+            if not offload :
+                await asyncio.sleep(0)
+            #end if
+        #end while
+        return \
+            BulkWatchResult(watches, errors)
+    #end watch_many_async
+
+    def _drop_watch(self, wd) :
+        # common code for removing a watch from the watch table.
+        self._activity.pop(wd, None)
+        if self._snapshots != None :
+            self._snapshots.pop(wd, None)
+        #end if
+        if self._digests != None and wd in self._digests :
+            self._stale_digest(wd)
+            del self._digests[wd]
+        #end if
+        watch = self._watches.pop(wd, None)
+        if watch == None :
+            watch = Watch._instances.get((wd, self.fd))
+        #end if
+        if wd in self._tree :
+            if watch != None :
+                # remember final state
+                watch._pathname = self._tree.path(wd)
+                watch._mask = self._tree.mask(wd)
+            #end if
+            self._tree.remove(wd)
+        #end if
+        return \
+            watch
+    #end _drop_watch
+
+    def watch_tree(self, root, mask, since = None) :
+        "adds watches for the directory root and every directory beneath it," \
+        " and keeps adding watches for new directories as they are created or" \
+        " moved into the tree. Since files can be created in a new directory" \
+        " before its watch takes effect, it is scanned once the watch is in" \
+        " place, and CREATE events are synthesized for whatever is found; a" \
+        " file created in that window may therefore be reported twice. IN.CREATE," \
+        " IN.MOVED_FROM, IN.MOVED_TO and IN.ONLYDIR are always added to mask," \
+        " so that directories renamed within the tree can be followed. Returns a" \
+        " TreeSetup giving the Watch for root, the number of watches added and" \
+        " the time taken.\n" \
+        "\n" \
+        "since, if not None, is a TreeSnapshot as saved by save_snapshot() before" \
+        " a restart. Each directory in the tree whose mtime differs from that" \
+        " saved is then compared with its saved entries, and IN.CREATE, IN.DELETE" \
+        " and IN.MODIFY events (as permitted by mask) are queued for the" \
+        " differences. Directories whose mtime is unchanged are not scanned, so" \
+        " modifications to existing files within them are not detected."
+        start = time.monotonic()
+        mask |= IN.CREATE | IN.MOVE | IN.ONLYDIR
+        top = self.watch(root, mask)
+        self._tree.mark_tree(top.wd)
+        nr_watches = 1 + self._watch_subtree(top)
+        if since != None :
+            # (new directories are already being watched)
+            self._dispatch_synthesized(self._catch_up(top.wd, since))
+        #end if
+        return \
+            TreeSetup(top, nr_watches, time.monotonic() - start)
+    #end watch_tree
+
+    def _dispatch_synthesized(self, records) :
+        # queues records synthesized other than from a read of the kernel
+        # queue, or passes them to the raw handler, in whichever form it
+        # expects.
+        if self._raw_columnar and self._raw_handler != None :
+            if len(records) != 0 :
+                self._raw_handler(EventBatch.from_records(records))
+            #end if
+        else :
+            self._dispatch(records)
+        #end if
+    #end _dispatch_synthesized
+
+    def _catch_up(self, top_wd, since) :
+        # returns records for the differences between the tree under top_wd
+        # and the TreeSnapshot since.
+        result = []
+        tree = self._tree
+        snapshots = self._snapshots
+        for wd in [top_wd] + tree.descendants(top_wd) :
+            pathname = tree.path(wd)
+            snapshot = (lambda : None, lambda : snapshots.get(wd))[snapshots != None]()
+            if snapshot != None :
+                dir_mtime = snapshot[0] # just taken
+            else :
+                try :
+                    dir_mtime = os.stat(pathname).st_mtime_ns
+                except OSError :
+                    dir_mtime = None
+                #end try
+            #end if
+            if dir_mtime != None and dir_mtime != since.dir_mtime(pathname) :
+                if snapshot == None :
+                    snapshot = _snapshot_dir(pathname)
+                #end if
+                if snapshot != None :
+                    old_entries = since.entries(pathname)
+                    if old_entries == None :
+                        # new directory
+                        old_entries = {}
+                    #end if
+                    result.extend(_diff_entries(wd, old_entries, snapshot[1], tree.mask(wd)))
+                #end if
+            #end if
+        #end for
+        return \
+            result
+    #end _catch_up
+
+    def save_snapshot(self, filename) :
+        "saves the state of all directories being watched to the specified file," \
+        " to be loaded with TreeSnapshot.load() and passed to watch_tree() after" \
+        " a restart. Call this once all events received so far have been dealt" \
+        " with. With recover_overflow, the snapshots already being kept are" \
+        " saved, rescanning only those directories that have had events since" \
+        " their last scan; otherwise every directory is scanned. With" \
+        " digest_index, the digests are saved as well."
+        tree = self._tree
+        snapshots = self._snapshots
+        digests = self._digests
+
+        def each_dir() :
+            for wd in list(tree.wds()) :
+                if snapshots != None :
+                    snapshot = self._fresh_snapshot(wd)
+                    if snapshot != None and snapshot[0] == None :
+                        snapshot = None
+                    #end if
+                else :
+                    snapshot = _snapshot_dir(tree.path(wd))
+                #end if
+                if snapshot != None :
+                    yield \
+                        (
+                            tree.path(wd),
+                            snapshot,
+                            (lambda : None, lambda : self._digest_of(wd))[digests != None](),
+                        )
+                #end if
+            #end for
+        #end each_dir
+
+    #begin save_snapshot
+        TreeSnapshot._save(filename, each_dir(), digests != None)
+    #end save_snapshot
+
+    def _fresh_snapshot(self, wd) :
+        # returns the snapshot for the directory watched by wd, rescanning it
+        # first if it has had events since it was last scanned, or None if
+        # there is no snapshot for it. The mtime in the snapshot is left as
+        # None if the directory could not be rescanned.
+        snapshot = self._snapshots.get(wd)
+        if snapshot != None and snapshot[0] == None :
+            new = _snapshot_dir(self._tree.path(wd))
+            if new != None :
+                snapshot[:] = new
+            #end if
+        #end if
+        return \
+            snapshot
+    #end _fresh_snapshot
+
+    def _stale_digest(self, wd, entries = True) :
+        # marks the digest of the subtree under the directory watched by wd as
+        # needing to be recomputed, along with those of all the directories
+        # above it, and also the digest of its own entries if entries.
+        digests = self._digests
+        tree = self._tree
+        node = digests.get(wd)
+        if node != None and entries :
+            node[0] = None
+        #end if
+        while node != None :
+            node[1] = None
+            wd = (lambda : -1, lambda : tree._parent(wd))[wd in tree]()
+            node = digests.get(wd)
+            if node != None and node[1] == None :
+                # already marked, and so is everything above
+                break
+            #end if
+        #end while
+    #end _stale_digest
+
+    def _digest_of(self, wd) :
+        # returns the pair of integers (digest of entries, digest of subtree)
+        # for the directory watched by wd, recomputing whatever is stale.
+        node = self._digests[wd]
+        if node[1] == None :
+            if node[0] == None :
+                snapshot = self._fresh_snapshot(wd)
+                entries = (lambda : {}, lambda : snapshot[1])[snapshot[0] != None]()
+                node[0] = sum(itertools.starmap(_entry_digest, entries.items())) % _DIGEST_MOD
+            #end if
+            total = node[0]
+            for name, child in self._tree.children.get(wd, {}).items() :
+                if child in self._digests :
+                    total += _subtree_digest(os.fsencode(name), self._digest_of(child)[1])
+                #end if
+            #end for
+            node[1] = total % _DIGEST_MOD
+        #end if
+        return \
+            tuple(node)
+    #end _digest_of
+
+    def _digest_pair(self, pathname) :
+        # returns the pair of integers (digest of entries, digest of subtree)
+        # for the directory pathname, or None if it is not being watched.
+        if self._digests == None :
+            raise ValueError("watcher has no digest_index")
+        #end if
+        wd = self._tree.lookup(self._pathname_args(pathname)[0])
+        return \
+            (lambda : None, lambda : self._digest_of(wd))[wd != None and wd in self._digests]()
+    #end _digest_pair
+
+    def digest(self, pathname) :
+        "returns the digest of the watched directory pathname and everything" \
+        " watched beneath it, as bytes, or None if it is not being watched." \
+        " Requires digest_index."
+        digests = self._digest_pair(pathname)
+        return \
+            (lambda : None, lambda : digests[1].to_bytes(_DIGEST_SIZE, "little"))[digests != None]()
+    #end digest
+
+    def compare_trees(self, pathname, other, other_pathname = None) :
+        "compares the tree watched at pathname with the one at other_pathname" \
+        " (default the same as pathname) in other, which is either a Watcher" \
+        " created with digest_index or a TreeSnapshot saved by one. Returns a" \
+        " list of pathnames, relative to the tops of the trees, of directories" \
+        " whose entries differ or that are missing from other. Only subtrees" \
+        " whose digests differ are descended into, so identical trees cost a" \
+        " single comparison. Since digests cover inode numbers, this is for" \
+        " comparing a tree with an earlier state of itself, not with a copy."
+        if other_pathname == None :
+            other_pathname = pathname
+        #end if
+        if self._digests == None :
+            raise ValueError("watcher has no digest_index")
+        #end if
+        tree = self._tree
+        top = tree.lookup(self._pathname_args(pathname)[0])
+        if top == None :
+            raise ValueError("%s is not being watched" % pathname)
+        #end if
+        result = []
+        to_compare = [(top, self._pathname_args(pathname)[0][:0])]
+        while len(to_compare) != 0 :
+            wd, relpath = to_compare.pop()
+            mine = self._digest_of(wd)
+            theirs = other._digest_pair(os.path.join(other_pathname, relpath))
+            if theirs == None :
+                result.append(relpath)
+            elif mine[1] != theirs[1] :
+                if mine[0] != theirs[0] :
+                    result.append(relpath)
+                #end if
+                for name, child in tree.children.get(wd, {}).items() :
+                    if child in self._digests :
+                        to_compare.append((child, os.path.join(relpath, name)))
+                    #end if
+                #end for
+            #end if
+        #end while
+        return \
+            result
+    #end compare_trees
+
+    @property
+    def watches(self) :
+        "returns a list of currently-associated Watch objects, sorted by pathname." \
+        " The sorted list is cached until the set of watches or their paths change."
+        tree = self._tree
+        if self._sorted_watches == None or self._sorted_watches[0] != tree.version :
+            self._sorted_watches = \
+                (
+                    tree.version,
+                    sorted(tree.wds(), key = tree.path),
+                )
+        #end if
+        return \
+            list(self._watch_for(wd) for wd in self._sorted_watches[1])
+    #end watches
+
+    def _fullpath_for(self, wd, name) :
+        # returns a tuple of the decoded name and the full pathname for the
+        # file called name (bytes) within the directory watched by wd, which
+        # must be in the watch table. Results are kept in an LRU cache that is
+        # emptied whenever the table changes, since that can rename things.
+        tree = self._tree
+        cache = self._fullpaths
+        if self._fullpaths_version != tree.version :
+            cache.clear()
+            self._fullpaths_version = tree.version
+        #end if
+        key = (wd, name)
+        result = cache.get(key)
+        if result != None :
+            cache.move_to_end(key)
+        else :
+            if self._bytes_paths :
+                decoded = name
+            else :
+                decoded = sys.intern(os.fsdecode(name))
+            #end if
+            dirname = tree.path(wd)
+            if len(name) != 0 :
+                result = (decoded, os.path.join(dirname, decoded))
+            else :
+                result = (decoded, dirname)
+            #end if
+            cache[key] = result
+            if len(cache) > FULLPATH_CACHE_MAX :
+                cache.popitem(last = False)
+            #end if
+        #end if
+        return \
+            result
+    #end _fullpath_for
+
+    def get_watch(self, pathname) :
+        "returns the Watch for the given pathname, or None if it is not being" \
+        " watched. The path is normalized as per os.path.normpath() but is not" \
+        " otherwise resolved, so it must be spelled the same way as when the" \
+        " watch was added (or as it has become through renames within a tree)."
+        wd = self._tree.lookup(self._pathname_args(pathname)[0])
+        return \
+            (lambda : None, lambda : self._watch_for(wd))[wd != None]()
+    #end get_watch
+
+    def watches_under(self, pathname) :
+        "returns a list of the Watch objects for pathname and everything being" \
+        " watched beneath it, in no particular order."
+        return \
+            list \
+              (
+                self._watch_for(wd)
+                for wd in self._tree.under(self._pathname_args(pathname)[0])
+              )
+    #end watches_under
+
+    def __del__(self) :
+        if self._poll_handle != None :
+            if self._loop != None :
+                self._poll_handle.cancel()
+            #end if
+            self._poll_handle = None
+        #end if
+        if self.fd != None :
+            if self._reader_thread != None :
+                self._reader_thread.stop()
+                self._reader_thread = None
+            elif self._reader_installed :
+                self._add_remove_watch(False)
+            #end if
+            os.close(self.fd)
+        #end if
+        self.fd = None
+    #end __del__
+
+    def fileno(self) :
+        return \
+            self.fd
+    #end fileno
+
+    def _pending_bytes(self) :
+        # returns the number of bytes waiting to be read from the kernel queue.
+        return \
+            _pending_bytes(self.fd)
+    #end _pending_bytes
+
+    def _callback(self, max_bytes = None) :
+        # called by asyncio when there is a notification event to be read.
+        # Keeps reading until the kernel queue is empty, so that a burst
+        # of events is collected in a single wakeup, or until max_bytes (if
+        # not None) have been read, in which case the rest is left for the
+        # next wakeup and True is returned. Also stops if reading is paused or
+        # blocked meanwhile, leaving the rest in the kernel queue.
+        min_size = ct.sizeof(inotify_event) + NAME_MAX + 1
+        nr_events = 0
+        nr_bytes = 0
+        limited = False
+        stopped = False
+        pending = self._pending_bytes()
+        while pending != 0 :
+            if self._bufsize != None :
+                if pending > self._bufsize and self._bufsize < READ_BUFSIZE_MAX :
+                    # burst exceeds buffer, grow it for next time
+                    self._bufsize = min(max(self._bufsize * 2, pending), READ_BUFSIZE_MAX)
+                #end if
+                size = self._bufsize
+            else :
+                size = max(pending, min_size)
+            #end if
+            if len(self._buf) < size :
+                self._buf = bytearray(size)
+            #end if
+            size = len(self._buf)
+            if max_bytes != None :
+                size = min(size, max(max_bytes - nr_bytes, min_size))
+            #end if
+            if self._max_pending != None and self._overflow == OVERFLOW.BLOCK :
+                # read no more records than there is room for, given that each
+                # is at least the size of the fixed part
+                room = max(self._max_pending - len(self._notifs), 0)
+                size = min(size, max(room * ct.sizeof(inotify_event), min_size))
+            #end if
+            if size < len(self._buf) :
+                bufs = [memoryview(self._buf)[:size]]
+            else :
+                bufs = [self._buf]
+            #end if
+            try :
+                nbytes = os.readv(self.fd, bufs)
+            except BlockingIOError :
+                break
+            #end try
+            self.nr_reads += 1
+            nr_bytes += nbytes
+            if self._raw_columnar and self._raw_handler != None :
+                records = EventBatch.from_buffer(self._buf, nbytes)
+                nr_events += len(records)
+                self._dispatch_columnar(records)
+            else :
+                records = _parse_events(self._buf, nbytes)
+                nr_events += len(records)
+                self._process_read(records)
+            #end if
+            pending = self._pending_bytes()
+            if max_bytes != None and nr_bytes >= max_bytes and pending != 0 :
+                limited = True
+                break
+            #end if
+            if (self._blocked or self._paused) and pending != 0 :
+                stopped = True
+                break
+            #end if
+        #end while
+        self._end_wakeup(nr_events, limited or stopped)
+        return \
+            limited
+    #end _callback
+
+    def _process_read(self, records) :
+        # passes records from a read of the kernel queue through the
+        # bookkeeping for whichever features are enabled, then dispatches them.
+        if self._budget != None :
+            records = self._note_activity(records)
+        #end if
+        if self._snapshots != None :
+            records = self._follow_snapshots(records)
+        #end if
+        if self._tree.nr_trees != 0 :
+            records = self._track_trees(records)
+        #end if
+        self._dispatch(records)
+        if len(self._evicted_gone) != 0 :
+            self._release_evicted()
+        #end if
+    #end _process_read
+
+    def _release_evicted(self) :
+        # releases the Watch objects for evicted watches whose IN.IGNORED has
+        # just been read, once there are no more of their events left in the
+        # queue. As the IN.IGNORED is the last event for its wd, that is as
+        # soon as _popleft() has got past all the records queued up to now.
+        notifs = self._notifs
+        end = notifs.base + len(notifs.names)
+        for wd in self._evicted_gone :
+            if len(notifs) == 0 :
+                self._zombies.pop(wd, None)
+            else :
+                self._releases.append((end, wd))
+            #end if
+        #end for
+        self._evicted_gone.clear()
+    #end _release_evicted
+
+    def _end_wakeup(self, nr_events, limited = False) :
+        # common code at the end of processing a wakeup’s worth of events.
+        # If limited, the kernel queue was not emptied, and the other halves
+        # of any renames may be yet to be read, so they are left for later.
+        if len(self._moves) != 0 and not limited :
+            self._moved_out()
+        #end if
+        if self._merged != None and not limited :
+            merged = self._merged()
+            if merged != None :
+                merged._shard_moved_out(self)
+            #end if
+        #end if
+        self.nr_wakeups += 1
+        self.nr_events += nr_events
+        self.last_wakeup_events = nr_events
+    #end _end_wakeup
+
+    def _thread_batch(self, records, nr_reads) :
+        # called on the loop with a batch of records read by the reader thread.
+        if self.fd != None :
+            self.nr_reads += nr_reads
+            if self._raw_columnar and self._raw_handler != None :
+                self._dispatch_columnar(EventBatch.from_records(records))
+            else :
+                self._process_read(records)
+            #end if
+            self._end_wakeup(len(records))
+        #end if
+    #end _thread_batch
+
+    def _forget_watch(self, wd) :
+        # called on IN.IGNORED: the kernel has dropped the watch.
+        watch = self._drop_watch(wd)
+        if watch != None :
+            watch._parent = None # Watch object doesn’t need to remove itself
+        #end if
+        return \
+            watch
+    #end _forget_watch
+
+    def _track_trees(self, records, inline = True) :
+        # looks for directories appearing within, moving around within, or
+        # leaving trees being watched by watch_tree(), and updates the watch
+        # table accordingly. Renames are matched up by cookie. Returns records
+        # with synthesized events for the contents of new directories inserted
+        # after the events announcing them, or just the synthesized events if
+        # not inline.
+        result = []
+        tree = self._tree
+        for rec in records :
+            if inline :
+                result.append(rec)
+            #end if
+            wd, mask, cookie, name = rec
+            if mask & IN.ISDIR != 0 :
+                if not self._bytes_paths :
+                    name = os.fsdecode(name)
+                #end if
+                if mask & IN.MOVED_FROM != 0 :
+                    child = tree.child(wd, name)
+                    if child != None :
+                        self._moves[cookie] = child
+                    #end if
+                elif mask & IN.MOVED_TO != 0 :
+                    child = self._moves.pop(cookie, None)
+                    if child != None and child in tree and wd in tree :
+                        if self._digests != None :
+                            self._stale_digest(tree._parent(child), entries = False)
+                        #end if
+                        tree.move(child, wd, name)
+                        if self._digests != None :
+                            self._stale_digest(wd, entries = False)
+                        #end if
+                    elif tree.is_tree(wd) :
+                        result.extend(self._tree_add(wd, name))
+                    #end if
+                elif mask & IN.CREATE != 0 and tree.is_tree(wd) :
+                    result.extend(self._tree_add(wd, name))
+                #end if
+            #end if
+        #end for
+        return \
+            result
+    #end _track_trees
+
+    def _follow_snapshots(self, records, inline = True) :
+        # keeps the directory snapshots for recover_overflow up to date with
+        # records, and rescans on IN.Q_OVERFLOW. Returns records with the
+        # synthesized events inserted after the IN.Q_OVERFLOW, or just the
+        # synthesized events if not inline.
+        result = []
+        snapshots = self._snapshots
+        for rec in records :
+            if inline :
+                result.append(rec)
+            #end if
+            wd, mask, cookie, name = rec
+            if mask & IN.Q_OVERFLOW != 0 :
+                result.extend(self._rescan())
+            elif len(name) != 0 and wd in snapshots :
+                # Statting anything here could pick up later changes whose
+                # events have been lost, so just note what is now unknown.
+                snapshot = snapshots[wd]
+                if mask & (IN.DELETE | IN.MOVED_FROM) != 0 :
+                    snapshot[1].pop(name, None)
+                elif mask & _SNAPSHOT_EVENTS != 0 :
+                    snapshot[1][name] = (None, None, None, mask & IN.ISDIR != 0)
+                #end if
+                snapshot[0] = None # must rescan
+                if self._digests != None :
+                    self._stale_digest(wd)
+                #end if
+            #end if
+        #end for
+        return \
+            result
+    #end _follow_snapshots
+
+    def _rescan(self) :
+        # called on IN.Q_OVERFLOW with recover_overflow: rescans each watched
+        # directory whose mtime has changed since its snapshot, returning records
+        # for the differences found and replacing the snapshot.
+        start = time.monotonic()
+        result = []
+        nr_scanned = 0
+        nr_skipped = 0
+        tree = self._tree
+        for wd, snapshot in list(self._snapshots.items()) :
+            dirname = tree.path(wd)
+            try :
+                dir_mtime = os.stat(dirname).st_mtime_ns
+            except OSError :
+                # gone, IN.IGNORED will follow
+                dir_mtime = None
+            #end try
+            if dir_mtime == snapshot[0] :
+                nr_skipped += 1
+            elif dir_mtime != None :
+                new = _snapshot_dir(dirname)
+                if new != None :
+                    nr_scanned += 1
+                    result.extend(_diff_entries(wd, snapshot[1], new[1], tree.mask(wd)))
+                    snapshot[:] = new
+                    if self._digests != None :
+                        self._stale_digest(wd)
+                    #end if
+                #end if
+            #end if
+        #end for
+        self.last_recovery = \
+            OverflowRecovery(nr_scanned, nr_skipped, len(result), time.monotonic() - start)
+        return \
+            result
+    #end _rescan
+
+    def _moved_out(self) :
+        # called at the end of a wakeup for directories that were moved away
+        # and have not turned up again within a tree: stop watching them.
+        for child in self._moves.values() :
+            if child in self._tree :
+                for wd in reversed([child] + self._tree.descendants(child)) :
+                    watch = self._watch_for(wd)
+                    if watch != None :
+                        watch.remove()
+                    #end if
+                #end for
+            #end if
+        #end for
+        self._moves.clear()
+    #end _moved_out
+
+    def _note_activity(self, records) :
+        # for the watch budget: moves the directories that records are for to
+        # the recently-active end of the eviction order, and returns records
+        # less the IN.IGNORED events for watches that were evicted. The Watch
+        # objects for those are released by _release_evicted() once dispatched.
+        activity = self._activity
+        evicted = self._evicted
+        result = []
+        for rec in records :
+            wd = rec[0]
+            if wd in activity :
+                activity.move_to_end(wd)
+            #end if
+            if rec[1] & IN.IGNORED != 0 and wd in evicted :
+                evicted.discard(wd)
+                self._evicted_gone.append(wd)
+            else :
+                result.append(rec)
+            #end if
+        #end for
+        return \
+            result
+    #end _note_activity
+
+    def _make_room(self, count) :
+        # tries to make room within the watch budget for count more watches by
+        # evicting the least recently active directories that have no watched
+        # subdirectories. Returns the number of watches there is room for.
+        tree = self._tree
+        room = self._budget - len(tree)
+        if room < count :
+            for wd in list(self._activity) :
+                if room >= count :
+                    break
+                #end if
+                if wd not in tree.children :
+                    self._evict(wd)
+                    room += 1
+                #end if
+            #end for
+        #end if
+        return \
+            max(room, 0)
+    #end _make_room
+
+    def _evict(self, wd) :
+        # removes the watch on wd, moving its directory to the polling tier.
+        tree = self._tree
+        pathname = tree.path(wd)
+        mask = tree.mask(wd)
+        snapshot = (lambda : None, lambda : self._snapshots.get(wd))[self._snapshots != None]()
+        if snapshot != None :
+            snapshot = list(snapshot)
+        #end if
+        watch = self._watch_for(wd)
+        libc.inotify_rm_watch(self.fd, wd)
+        self._evicted.add(wd) # don’t report the IN.IGNORED
+        self._forget_watch(wd)
+        # keep the Watch object for events already read or still in the
+        # kernel queue, until its IN.IGNORED comes through
+        if watch != None :
+            self._zombies[wd] = watch
+        #end if
+        self.nr_evictions += 1
+        self._poll_tree(pathname, mask, snapshot)
+    #end _evict
+
+    def _poll_tree(self, pathname, mask, snapshot = None) :
+        # adds the directory pathname and everything beneath it to the polling
+        # tier, with snapshot as its state if not None.
+        to_add = [(pathname, snapshot)]
+        while len(to_add) != 0 :
+            pathname, snapshot = to_add.pop()
+            if snapshot == None :
+                snapshot = _snapshot_dir(pathname)
+            #end if
+            if snapshot != None :
+                self._polled[os.path.normpath(pathname)] = [mask, list(snapshot)]
+                for name, entry in snapshot[1].items() :
+                    if entry[3] :
+                        subdir = os.path.join(os.fsencode(pathname), name)
+                        if isinstance(pathname, str) :
+                            subdir = os.fsdecode(subdir)
+                        #end if
+                        if self._tree.lookup(subdir) == None :
+                            to_add.append((subdir, None))
+                        #end if
+                    #end if
+                #end for
+            #end if
+        #end while
+        self._schedule_poll()
+    #end _poll_tree
+
+    def _schedule_poll(self) :
+        # arranges for the polling tier to be checked after the poll interval,
+        # if it is not empty and this is not already arranged.
+        if self._poll_handle == None and len(self._polled) != 0 :
+            if self._loop != None :
+                loop = self._loop()
+                if loop != None :
+                    self._poll_handle = loop.call_later(self._poll_interval, _poll_watcher, weak_ref(self))
+                #end if
+            else :
+                # synchronous: just the time it is due, for read_events() to check
+                self._poll_handle = time.monotonic() + self._poll_interval
+            #end if
+        #end if
+    #end _schedule_poll
+
+    def _poll(self) :
+        # checks the directories in the polling tier for changes, reporting them
+        # and watching again those directories where they were found if possible.
+        self._poll_handle = None
+        tree = self._tree
+        records = []
+        for pathname, polled in list(self._polled.items()) :
+            mask, snapshot = polled
+            try :
+                dir_mtime = os.stat(pathname).st_mtime_ns
+            except OSError :
+                # gone, deletion will be reported against the directory above
+                dir_mtime = None
+                del self._polled[pathname]
+            #end try
+            if dir_mtime != None and dir_mtime != snapshot[0] :
+                new = _snapshot_dir(pathname)
+                if new != None :
+                    changes = _diff_entries(-1, snapshot[1], new[1], mask)
+                    polled[1] = list(new)
+                    if len(changes) != 0 :
+                        parent_wd = tree.lookup(os.path.dirname(pathname))
+                        watch = None
+                        if parent_wd != None :
+                            try :
+                                watch = self._add_watch \
+                                  (
+                                    pathname,
+                                    os.fsencode(pathname),
+                                    mask,
+                                    parent_wd,
+                                    os.path.basename(pathname),
+                                    True
+                                  )
+                                self.nr_restores += 1
+                            except OSError :
+                                pass
+                            #end try
+                        #end if
+                        if watch != None :
+                            wd = watch.wd
+                            prefix = b""
+                        else :
+                            # report against nearest watched directory above
+                            above = pathname
+                            wd = None
+                            while wd == None and above != os.path.dirname(above) :
+                                above = os.path.dirname(above)
+                                wd = tree.lookup(above)
+                            #end while
+                            prefix = os.path.relpath(os.fsencode(pathname), os.fsencode(above))
+                        #end if
+                        for change in changes :
+                            name = change[3]
+                            if wd != None :
+                                records.append((wd, change[1], 0, os.path.join(prefix, name)))
+                            #end if
+                            if change[1] & IN.ISDIR != 0 :
+                                subdir = (name, os.fsdecode(name))[isinstance(pathname, str)]
+                                if change[1] & IN.CREATE == 0 :
+                                    self._polled.pop(os.path.normpath(os.path.join(pathname, subdir)), None)
+                                elif watch != None :
+                                    records.extend(self._tree_add(wd, subdir))
+                                else :
+                                    self._poll_tree(os.path.join(pathname, subdir), mask)
+                                #end if
+                            #end if
+                        #end for
+                    #end if
+                #end if
+            #end if
+        #end for
+        self._dispatch_synthesized(records)
+        self._schedule_poll()
+    #end _poll
+
+    @property
+    def nr_watches(self) :
+        "the number of watches currently held."
+        return \
+            len(self._tree)
+    #end nr_watches
+
+    @property
+    def nr_polled(self) :
+        "the number of directories in the polling tier (see watch_budget)."
+        return \
+            len(self._polled)
+    #end nr_polled
+
+    def estimate_tree(self, root) :
+        "a dry run for watch_tree(root, …): returns a TreeEstimate giving the number" \
+        " of watches it would need, found without statting anything other than" \
+        " directories, and the number available. The latter is the room left in" \
+        " the watch_budget if there is one; otherwise it is max_user_watches()" \
+        " less the watches held by this Watcher, not counting other users of" \
+        " inotify, or None if the limit cannot be read."
+        count = 0
+        to_scan = [root]
+        while len(to_scan) != 0 :
+            pathname = to_scan.pop()
+            try :
+                with os.scandir(pathname) as entries :
+                    count += 1
+                    for entry in entries :
+                        if entry.is_dir(follow_symlinks = False) :
+                            to_scan.append(entry.path)
+                        #end if
+                    #end for
+                #end with
+            except OSError :
+                pass
+            #end try
+        #end while
+        if self._budget != None :
+            available = max(self._budget - len(self._tree), 0)
+        else :
+            available = max_user_watches()
+            if available != None :
+                available = max(available - len(self._tree), 0)
+            #end if
+        #end if
+        return \
+            TreeEstimate(count, available)
+    #end estimate_tree
+
+    def _tree_add(self, parent_wd, name) :
+        # adds watches for a new directory called name within the directory
+        # watched by parent_wd, and everything beneath it, returning records
+        # for CREATE events for whatever was found inside, since those may
+        # have been created before the watches took effect.
+        result = []
+        if parent_wd in self._tree :
+            pathname = os.path.join(self._tree.path(parent_wd), name)
+            mask = self._tree.mask(parent_wd)
+            try :
+                watch = self._add_watch(pathname, os.fsencode(pathname), mask, parent_wd, name, True)
+            except OSError as fail :
+                # gone already, or not accessible, or no room
+                watch = None
+                if fail.errno == ENOSPC and self._budget != None :
+                    self._poll_tree(pathname, mask)
+                #end if
+            #end if
+            if watch != None :
+                self._watch_subtree(watch, result)
+            #end if
+        #end if
+        return \
+            result
+    #end _tree_add
+
+    def _watch_subtree(self, top, catch_up = None) :
+        # adds watches for all directories beneath the one watched by top,
+        # returning the number added. If catch_up is not None, records for
+        # CREATE events for everything found are appended to it.
+        count = 0
+        mask = top.mask
+        to_scan = [top]
+        while len(to_scan) != 0 :
+            parent = to_scan.pop()
+            try :
+                entries = list(os.scandir(parent.pathname))
+            except OSError :
+                # vanished or inaccessible
+                entries = []
+            #end try
+            for entry in entries :
+                try :
+                    isdir = entry.is_dir(follow_symlinks = False)
+                except OSError :
+                    isdir = False
+                #end try
+                if catch_up != None :
+                    catch_up.append \
+                      (
+                        (parent.wd, IN.CREATE | (0, IN.ISDIR)[isdir], 0, os.fsencode(entry.name))
+                      )
+                #end if
+                if isdir :
+                    try :
+                        watch = self._add_watch \
+                          (
+                            entry.path,
+                            os.fsencode(entry.path),
+                            mask,
+                            parent.wd,
+                            entry.name,
+                            True
+                          )
+                    except OSError as fail :
+                        watch = None
+                        if fail.errno == ENOSPC and self._budget != None :
+                            self._poll_tree(entry.path, mask)
+                        #end if
+                    #end try
+                    if watch != None :
+                        count += 1
+                        to_scan.append(watch)
+                    #end if
+                #end if
+            #end for
+        #end while
+        return \
+            count
+    #end _watch_subtree
+
+    def _dispatch(self, records) :
+        # queues records from _parse_events, or hands them to the raw handler
+        # if one is set. Events are only constructed when they are taken off
+        # the queue, by _popleft().
+        if self._raw_handler != None :
+            self._dispatch_raw(records)
+            return
+        #end if
+        notifs = self._notifs
+        max_pending = self._max_pending
+        for wd, mask, cookie, name in records :
+            if mask & IN.IGNORED != 0 :
+                # watch is gone, but keep its Watch object for events already queued
+                watch = self._forget_watch(wd)
+                if watch != None :
+                    self._zombies[wd] = watch
+                #end if
+            elif wd < 0 :
+                assert mask & IN.Q_OVERFLOW != 0
+            #end if
+            if (
+                    max_pending != None
+                and
+                    len(notifs) >= max_pending
+                and
+                    mask & (IN.IGNORED | IN.Q_OVERFLOW) == 0
+                      # always let these through
+            ) :
+                overflow = self._overflow
+                if overflow == OVERFLOW.DROP_NEWEST :
+                    self.nr_dropped[overflow] += 1
+                    continue
+                elif overflow == OVERFLOW.COALESCE :
+                    self.nr_dropped[overflow] += 1
+                    existing = self._coalesce.get((wd, name))
+                    if existing != None :
+                        notifs.or_mask(existing, mask)
+                    #end if
+                    continue
+                elif overflow == OVERFLOW.DROP_OLDEST :
+                    # (sequence numbers only matter for COALESCE)
+                    if notifs.drop_first(IN.IGNORED | IN.Q_OVERFLOW) :
+                        self.nr_dropped[overflow] += 1
+                    #end if
+                #end if
+                # else OVERFLOW.BLOCK: already read, so keep it
+            #end if
+            seq = notifs.append(wd, mask, cookie, name)
+            if self._coalesce != None :
+                self._coalesce[(wd, name)] = seq
+            #end if
+            if max_pending != None and len(notifs) >= max_pending and not self._above_high :
+                self._above_high_water()
+            #end if
+            if len(self._awaiting) != 0 :
+                # one waiter for each event
+                self._wake_waiter()
+            #end if
+        #end for
+        if self._merged != None :
+            merged = self._merged()
+            if merged != None :
+                merged._shard_records(self, records)
+            #end if
+        #end if
+    #end _dispatch
+
+    def _above_high_water(self) :
+        # called when the queue of pending events fills up to max_pending.
+        self._above_high = True
+        if self._overflow == OVERFLOW.BLOCK :
+            self._blocked = True
+            self._update_reader()
+        #end if
+        if self._on_high_water != None :
+            self._on_high_water(self)
+        #end if
+    #end _above_high_water
+
+    def _below_low_water(self) :
+        # called when the queue of pending events drains down to low_water
+        # after having filled up.
+        self._above_high = False
+        if self._blocked :
+            self._blocked = False
+            self._update_reader()
+        #end if
+        if self._on_low_water != None :
+            self._on_low_water(self)
+        #end if
+    #end _below_low_water
+
+    def _popleft(self, materialize = True) :
+        # removes the record at the head of the queue and returns it as an Event.
+        seq, wd, mask, cookie, name = self._notifs.popleft()
+        if self._coalesce != None :
+            key = (wd, name)
+            if self._coalesce.get(key) == seq :
+                del self._coalesce[key]
+            #end if
+        #end if
+        if mask & IN.IGNORED != 0 :
+            watch = self._zombies.pop(wd, None)
+        elif materialize and wd >= 0 :
+            watch = self._zombies.get(wd)
+            if watch == None :
+                watch = self._watch_for(wd)
+            #end if
+        else :
+            watch = None
+        #end if
+        if self._above_high and len(self._notifs) <= self._low_water :
+            self._below_low_water()
+        #end if
+        if materialize :
+            event = Event(watch, mask, cookie, name, (None, name)[self._bytes_paths])
+        else :
+            event = None
+        #end if
+        releases = self._releases
+        while len(releases) != 0 and releases[0][0] <= seq + 1 :
+            self._zombies.pop(releases.popleft()[1], None)
+        #end while
+        return \
+            event
+    #end _popleft
+
+    def set_watermark_callbacks(self, on_high_water, on_low_water) :
+        "sets callbacks to be invoked, with the Watcher as argument, when the" \
+        " queue of pending events fills up to max_pending (on_high_water), and" \
+        " when it subsequently drains down to low_water (on_low_water). Either" \
+        " may be None. See create() for how these limits are set."
+        self._on_high_water = on_high_water
+        self._on_low_water = on_low_water
+    #end set_watermark_callbacks
+
+    def _wake_waiter(self) :
+        # wakes up the task at head of waiter queue, skipping over any
+        # that have timed out or been cancelled. Also need to remove it
+        # from the queue here, in case anybody else is also waiting behind
+        # it and I have additional incoming messages for them.
+        while len(self._awaiting) != 0 :
+            awaiting = self._awaiting.popleft()
+            if not awaiting.done() :
+                awaiting.set_result(True)
+                break
+            #end if
+            self._nr_stale_waiters -= 1
+        #end while
+    #end _wake_waiter
+
+    def _dispatch_raw(self, records) :
+        # passes records from _parse_events straight to the raw handler.
+        handler = self._raw_handler
+        if self._raw_batch :
+            for rec in records :
+                if rec[1] & IN.IGNORED != 0 :
+                    self._forget_watch(rec[0])
+                #end if
+            #end for
+            handler(records)
+        else :
+            for wd, mask, cookie, name in records :
+                if mask & IN.IGNORED != 0 :
+                    self._forget_watch(wd)
+                #end if
+                handler(wd, mask, cookie, name)
+            #end for
+        #end if
+    #end _dispatch_raw
+
+    def _dispatch_columnar(self, batch) :
+        # passes an EventBatch straight to the raw handler.
+        if self._budget != None :
+            activity = self._activity
+            for wd in set(batch.wd.tolist()) :
+                if wd in activity :
+                    activity.move_to_end(wd)
+                #end if
+            #end for
+        #end if
+        if len(self._evicted) != 0 :
+            # leave out the IN.IGNORED events for evicted watches, as _note_activity does
+            gone = set(batch.select(mask = IN.IGNORED, wds = self._evicted).wd.tolist())
+            if len(gone) != 0 :
+                batch = EventBatch.from_records \
+                  (
+                    list
+                      (
+                        rec for rec in batch
+                        if rec[1] & IN.IGNORED == 0 or rec[0] not in gone
+                      )
+                  )
+                for wd in gone :
+                    self._evicted.discard(wd)
+                    self._zombies.pop(wd, None)
+                #end for
+            #end if
+        #end if
+        for wd in batch.select(mask = IN.IGNORED).wd :
+            self._forget_watch(int(wd))
+        #end for
+        extra = []
+        if self._snapshots != None :
+            extra.extend \
+              (
+                self._follow_snapshots(batch.select(mask = _SNAPSHOT_EVENTS), inline = False)
+              )
+        #end if
+        if self._tree.nr_trees != 0 :
+            extra.extend \
+              (
+                self._track_trees
+                  (
+                    itertools.chain(batch.select(mask = IN.ISDIR), list(extra)),
+                    inline = False
+                  )
+              )
+        #end if
+        self._raw_handler(batch)
+        if len(extra) != 0 :
+            self._raw_handler(EventBatch.from_records(extra))
+        #end if
+    #end _dispatch_columnar
+
+    def set_raw_handler(self, handler, batch = False, columnar = False) :
+        "installs a handler that receives events straight from the read buffer," \
+        " bypassing construction of Event objects, the queue read by get() and" \
+        " any futures. If batch is False, handler is called once per event as" \
+        "\n" \
+        "    handler(wd, mask, cookie, name)\n" \
+        "\n" \
+        "where wd, mask and cookie are ints and name is the raw bytes of the" \
+        " filename (empty if none). If batch is True, it is called once per read" \
+        " with a list of (wd, mask, cookie, name) tuples. wd is -1 for an" \
+        " IN.Q_OVERFLOW event; use Watch.wd to match other events to your" \
+        " watches. Pass None as the handler to go back to queueing Events.\n" \
+        "\n" \
+        "If columnar is True, handler is called once per read with an EventBatch" \
+        " instead, which holds the events decoded into arrays for vectorized" \
+        " filtering and counting.\n" \
+        "\n" \
+        "The reader callback stays installed on the event loop for as long as" \
+        " a raw handler is set."
+        self._raw_handler = handler
+        self._raw_batch = batch
+        self._raw_columnar = columnar
+        self._update_reader()
+    #end set_raw_handler
+
+    async def _wait(self, timeout) :
+        # waits until an event may have been queued, returning False if
+        # the timeout (if not None) elapsed first.
+
+        def timedout(w_awaiting) :
+            awaiting = w_awaiting()
+            if awaiting != None and not awaiting.done() :
+                awaiting.set_result(False)
+            #end if
+        #end timedout
+
+    #begin _wait
+        if self._loop == None :
+            raise RuntimeError("synchronous Watcher: use read_events() instead")
+        #end if
+        loop = self._loop()
+        assert loop != None, "loop has gone away"
+        if timeout != None and timeout <= 0 :
+            return \
+                False
+        #end if
+        awaiting = loop.create_future()
+        timeout_task = None
+        if timeout != None :
+            timeout_task = loop.call_later(timeout, timedout, weak_ref(awaiting))
+        #end if
+        self._awaiting.append(awaiting)
+        self._reader_count += 1
+        self._update_reader()
+        try :
+            got_one = await awaiting
+        except asyncio.CancelledError :
+            if (
+                    not awaiting.cancelled()
+                and
+                    awaiting.result()
+                and
+                    len(self._notifs) != 0
+            ) :
+                # pass on the wakeup I was given but won’t be using
+                self._wake_waiter()
+            #end if
+            raise
+        finally :
+            self._reader_count -= 1
+            self._update_reader()
+            if timeout_task != None :
+                timeout_task.cancel()
+            #end if
+            if awaiting.cancelled() or not awaiting.result() :
+                # timed out or cancelled: leave it in the queue to be
+                # skipped over later, rather than searching for it now.
+                self._nr_stale_waiters += 1
+                if self._nr_stale_waiters * 2 > len(self._awaiting) :
+                    self._awaiting = deque(f for f in self._awaiting if not f.done())
+                    self._nr_stale_waiters = 0
+                #end if
+            #end if
+        #end try
+        return \
+            got_one
+    #end _wait
+
+    async def get(self, timeout = None) :
+        "waits for and returns the next available Event. Waits forever if" \
+        " necessary if timeout is None; else it is the number of seconds" \
+        " (fractions allowed) to wait; if no event becomes available during" \
+        " that time, None is returned."
+        while True :
+            if len(self._notifs) != 0 :
+                result = self._popleft()
+                break
+            #end if
+            if not await self._wait(timeout) :
+                result = None
+                break
+            #end if
+        #end while
+        return \
+            result
+    #end get
+
+    async def get_batch(self, max_events = None, timeout = None) :
+        "waits until at least one Event is available, then returns a list of" \
+        " all the Events already queued, up to max_events if this is not None." \
+        " timeout is as for get(); if no event becomes available during that" \
+        " time, an empty list is returned."
+        while True :
+            if len(self._notifs) != 0 :
+                result = self.drain(max_events)
+                break
+            #end if
+            if not await self._wait(timeout) :
+                result = []
+                break
+            #end if
+        #end while
+        return \
+            result
+    #end get_batch
+
+    def drain(self, max_events = None) :
+        "returns a list of the Events already queued, up to max_events if this" \
+        " is not None, without waiting. The list will be empty if there are none."
+        if max_events == None or max_events > len(self._notifs) :
+            max_events = len(self._notifs)
+        #end if
+        result = [self._popleft() for i in range(max_events)]
+        return \
+            result
+    #end drain
+
+    def iter_async(self, stop_on = None, timeout = None) :
+        "wrapper around get() to allow use with an async-for statement." \
+        " Lets you write\n" \
+        "\n" \
+        "    async for event in «watcher».iter_async(«stop_on», «timeout») :" \
+        "        «process event»\n" \
+        "    #end for\n" \
+        "\n" \
+        "to receive and process notifications in a loop. stop_on is an" \
+        " optional set of STOP_ON.xxx values indicating the conditions" \
+        " under which the iterator will raise StopAsyncIteration to" \
+        " terminate the loop."
+        stop_on = _check_stop_on(stop_on)
+        return \
+            _WatcherAiter(self, stop_on, timeout)
+    #end iter_async
+
+    def iter_batches(self, max_events = None, stop_on = None, timeout = None) :
+        "wrapper around get_batch() to allow use with an async-for statement." \
+        " Lets you write\n" \
+        "\n" \
+        "    async for events in «watcher».iter_batches(«max_events», «stop_on», «timeout») :" \
+        "        «process list of events»\n" \
+        "    #end for\n" \
+        "\n" \
+        "to receive and process notifications a batch at a time. stop_on is" \
+        " as for iter_async(); otherwise an empty list is returned on timeout."
+        stop_on = _check_stop_on(stop_on)
+        return \
+            _WatcherBatchAiter(self, max_events, stop_on, timeout)
+    #end iter_batches
+
+    def read_events(self, timeout = None, max_events = None) :
+        "blocks the calling thread until at least one Event is available, then" \
+        " returns a list of those queued, up to max_events if this is not None." \
+        " timeout is as for get(); if no event becomes available during that" \
+        " time, an empty list is returned. This is the way to retrieve events" \
+        " from a Watcher created with synchronous = True. Events are read from" \
+        " the kernel queue as for the reader callback, so if the Watcher is" \
+        " paused with none queued, an empty list is returned once the timeout" \
+        " has elapsed, or straight away if timeout is None, since nothing could" \
+        " arrive while this thread waits."
+        deadline = (lambda : None, lambda : time.monotonic() + timeout)[timeout != None]()
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        while True :
+            if len(self._notifs) != 0 :
+                result = self.drain(max_events)
+                break
+            #end if
+            if self._paused or self._blocked :
+                if deadline != None :
+                    time.sleep(max(deadline - time.monotonic(), 0))
+                #end if
+                result = []
+                break
+            #end if
+            now = time.monotonic()
+            if deadline != None :
+                wait = max(deadline - now, 0)
+            else :
+                wait = None
+            #end if
+            poll_due = None
+            if self._loop == None and self._poll_handle != None :
+                # polling tier is due at this time
+                poll_due = self._poll_handle
+                if wait == None or poll_due - now < wait :
+                    wait = max(poll_due - now, 0)
+                #end if
+            #end if
+            if wait != None :
+                wait *= 1000 # milliseconds
+            #end if
+            if len(poller.poll(wait)) != 0 :
+                self._callback()
+            elif poll_due != None and time.monotonic() >= poll_due :
+                self._poll()
+            elif deadline != None and time.monotonic() >= deadline :
+                result = []
+                break
+            #end if
+        #end while
+        return \
+            result
+    #end read_events
+
+    def iter_events(self, stop_on = None, timeout = None, max_events = None) :
+        "the equivalent of iter_async() for use with a plain for-statement, built" \
+        " on read_events(). Lets you write\n" \
+        "\n" \
+        "    for event in «watcher».iter_events(«stop_on», «timeout») :" \
+        "        «process event»\n" \
+        "    #end for\n" \
+        "\n" \
+        "Events are read max_events (if not None) at a time. On timeout, None is" \
+        " produced, or the iteration ends if stop_on contains STOP_ON.TIMEOUT." \
+        " The iteration also ends if the Watcher is paused with no events queued."
+        stop_on = _check_stop_on(stop_on)
+        while True :
+            events = self.read_events(timeout, max_events)
+            if len(events) == 0 :
+                if STOP_ON.TIMEOUT in stop_on or self._paused :
+                    break
+                #end if
+                yield None
+            #end if
+            for event in events :
+                yield event
+            #end for
+        #end while
+    #end iter_events
+
+#end Watcher
+
+class ShardedWatcher :
+    "spreads watches across several Watchers, each with its own inotify fd and" \
+    " hence its own kernel queue, bounded by max_queued_events, and presents the" \
+    " events from all of them as a single stream. Directories are assigned to" \
+    " shards by hashing the pathnames of the subtrees given to watch_tree()" \
+    " (each subdirectory of a tree root goes to its own shard). Events and" \
+    " Watch objects come from the shard Watchers, and are the same as for a" \
+    " single Watcher. Events for any one subtree are delivered in order, but there is" \
+    " no ordering between shards. Do not instantiate directly; use the create()" \
+    " method."
+
+    __slots__ = \
+        ( # to forestall typos
+            "__weakref__",
+            "_loop",
+            "_shards",
+            "_shard_args",
+            "_next",
+            "_awaiting",
+            "_nr_stale_waiters",
+            "_tops",
+            "_subtrees",
+            "_moves",
+            "_max_shards",
+            "_overflow_threshold",
+            "_overflow_window",
+            "_overflows",
+            "_splitting",
+            # statistics, readable by caller:
+            "nr_splits",
+        )
+
+    @classmethod
+    def create \
+      (
+        celf,
+        nr_shards = 2,
+        loop = None,
+        max_shards = None,
+        overflow_threshold = None,
+        overflow_window = 60.0,
+        **kwargs
+      ) :
+        "creates a new ShardedWatcher with nr_shards shards to begin with. Remaining" \
+        " keyword arguments are passed to Watcher.create() for each shard, except" \
+        " that shards are always persistent, so that each one is drained as its" \
+        " events arrive.\n" \
+        "\n" \
+        "If overflow_threshold is not None, then when a shard reports that many" \
+        " IN.Q_OVERFLOW events within overflow_window seconds, a new shard is" \
+        " added (up to max_shards, if not None), and half the subtrees on the" \
+        " overflowing shard are moved to it. Events for a subtree may be missed" \
+        " or duplicated while it is being moved."
+        if nr_shards < 1 :
+            raise ValueError("need at least one shard")
         #end if
-        result = celf(fd)
-        if result._loop == None :
-            result._loop = weak_ref(loop)
-        elif result._loop() != loop :
-            raise RuntimeError("watcher was not created on current event loop")
+        if loop == None :
+            loop = asyncio.get_event_loop()
         #end if
+        kwargs["loop"] = loop
+        kwargs["persistent"] = True
+        result = super().__new__(celf)
+        result._loop = weak_ref(loop)
+        result._shards = []
+        result._shard_args = kwargs
+        result._next = 0
+        result._awaiting = deque()
+        result._nr_stale_waiters = 0
+        result._tops = {}
+        result._subtrees = {}
+        result._moves = {}
+        result._max_shards = max_shards
+        result._overflow_threshold = overflow_threshold
+        result._overflow_window = overflow_window
+        result._overflows = {}
+        result._splitting = set()
+        result.nr_splits = 0
+        for i in range(nr_shards) :
+            result.add_shard()
+        #end for
         return \
             result
     #end create
 
+    def add_shard(self) :
+        "adds another shard, returning its Watcher. New subtrees will be spread" \
+        " across it as well; existing ones stay where they are."
+        shard = Watcher.create(**self._shard_args)
+        shard._merged = weak_ref(self)
+        self._shards.append(shard)
+        return \
+            shard
+    #end add_shard
+
+    @property
+    def shards(self) :
+        "returns a list of the shard Watchers, for looking at their statistics."
+        return \
+            list(self._shards)
+    #end shards
+
+    def _key(self, pathname) :
+        # returns pathname in the form the shards record it.
+        return \
+            os.path.normpath(self._shards[0]._pathname_args(pathname)[0])
+    #end _key
+
+    def _shard_for(self, pathname) :
+        # returns the shard to put pathname (as returned from _key) on.
+        return \
+            self._shards[zlib.crc32(os.fsencode(pathname)) % len(self._shards)]
+    #end _shard_for
+
     def watch(self, pathname, mask) :
-        "adds a watch for the specified path, or replaces any previous" \
-        " watch settings if there is already a watch on that path. Returns" \
-        " the Watch object, either the same one as before or a new one for a" \
-        " new path."
-        wd = libc.inotify_add_watch(self.fd, pathname.encode(), mask)
-        if wd < 0 :
-            errno = ct.get_errno()
-            raise OSError(errno, os.strerror(errno))
+        "adds a watch for the specified path on the shard its pathname hashes to," \
+        " or replaces the settings of an existing watch on it. Returns the Watch."
+        pathname = self._key(pathname)
+        shard = self._shard_for(pathname)
+        for other in self._shards :
+            if other.get_watch(pathname) != None :
+                shard = other
+                break
+            #end if
+        #end for
+        return \
+            shard.watch(pathname, mask)
+    #end watch
+
+    def _place_subtree(self, pathname, mask, catch_up, shard = None) :
+        # watches the directory pathname and everything beneath it on the
+        # shard it hashes to (or the given one), returning the number of
+        # watches added. If catch_up, CREATE events are synthesized for what
+        # is found, as for a directory created within a tree.
+        if shard == None :
+            shard = self._shard_for(pathname)
+        #end if
+        try :
+            top = shard.watch(pathname, mask)
+        except OSError :
+            # gone already, or not accessible
+            top = None
+        #end try
+        if top != None :
+            shard._tree.mark_tree(top.wd)
+            records = ([], None)[not catch_up]
+            count = 1 + shard._watch_subtree(top, records)
+            if catch_up :
+                shard._dispatch_synthesized(records)
+            #end if
+            self._subtrees[pathname] = (shard, mask)
+        else :
+            count = 0
+        #end if
+        return \
+            count
+    #end _place_subtree
+
+    def watch_tree(self, root, mask) :
+        "watches the directory root and everything beneath it, as for" \
+        " Watcher.watch_tree(), with root on one shard, and each of its" \
+        " subdirectories and everything beneath that on a shard chosen by" \
+        " hashing its pathname. Returns a TreeSetup giving the Watch for root," \
+        " the total number of watches added and the time taken."
+        start = time.monotonic()
+        mask |= IN.CREATE | IN.MOVE | IN.ONLYDIR
+        root = self._key(root)
+        shard = self._shard_for(root)
+        top = shard.watch(root, mask)
+        self._tops[(shard, top.wd)] = (root, mask)
+        nr_watches = 1
+        with os.scandir(root) as entries :
+            for entry in entries :
+                try :
+                    isdir = entry.is_dir(follow_symlinks = False)
+                except OSError :
+                    isdir = False
+                #end try
+                if isdir :
+                    nr_watches += self._place_subtree \
+                      (
+                        self._key(entry.path),
+                        mask,
+                        False
+                      )
+                #end if
+            #end for
+        #end with
+        return \
+            TreeSetup(top, nr_watches, time.monotonic() - start)
+    #end watch_tree
+
+    @staticmethod
+    def _remove_watches(watches) :
+        # removes watches for a subtree, bottom-up.
+        watches.sort(key = lambda w : len(w.pathname), reverse = True)
+        for watch in watches :
+            watch.remove()
+        #end for
+    #end _remove_watches
+
+    def _drop_subtree(self, pathname) :
+        # stops watching the subtree at pathname, wherever it is.
+        shard = self._subtrees.pop(pathname, (None,))[0]
+        if shard != None :
+            self._remove_watches(shard.watches_under(pathname))
+        #end if
+    #end _drop_subtree
+
+    def _shard_records(self, shard, records) :
+        # called by a shard after it has queued records: wakes waiters, keeps
+        # track of subdirectories of tree roots coming and going, and counts
+        # overflows. By now the shard has dropped the watches for any
+        # IN.IGNORED records, so pathnames are made from those saved for
+        # the roots, and roots going away can report deletions but get
+        # nothing new placed beneath them. Renames out of a root are left
+        # for _shard_moved_out(), in case the IN.MOVED_TO is still to be read.
+        tops = self._tops
+        dying = {}
+        for wd, mask, cookie, name in records :
+            if mask & IN.IGNORED != 0 and (shard, wd) in tops :
+                dying[wd] = tops.pop((shard, wd))
+            #end if
+        #end for
+        for wd, mask, cookie, name in records :
+            if len(self._awaiting) != 0 :
+                self._wake_waiter()
+            #end if
+            if mask & IN.Q_OVERFLOW != 0 :
+                self._note_overflow(shard)
+            elif mask & IN.ISDIR != 0 and ((shard, wd) in tops or wd in dying) :
+                root, top_mask = (lambda : dying[wd], lambda : tops[(shard, wd)])[wd not in dying]()
+                if not shard._bytes_paths :
+                    name = os.fsdecode(name)
+                #end if
+                pathname = os.path.join(root, name)
+                if mask & IN.MOVED_FROM != 0 :
+                    self._moves[cookie] = (shard, pathname)
+                elif mask & IN.MOVED_TO != 0 :
+                    old_pathname = self._moves.pop(cookie, (None, None))[1]
+                    placed = self._subtrees.pop(old_pathname, None)
+                    if placed != None :
+                        # renamed within the same root: follow it on its shard
+                        owner, sub_mask = placed
+                        owner_wd = owner._tree.lookup(old_pathname)
+                        if owner_wd != None :
+                            owner._tree.move(owner_wd, -1, pathname)
+                        #end if
+                        self._subtrees[pathname] = placed
+                    elif wd not in dying :
+                        self._place_subtree(pathname, top_mask, True)
+                    #end if
+                elif mask & IN.CREATE != 0 and wd not in dying :
+                    self._place_subtree(pathname, top_mask, True)
+                elif mask & IN.DELETE != 0 :
+                    self._subtrees.pop(pathname, None)
+                #end if
+            #end if
+        #end for
+    #end _shard_records
+
+    def _shard_moved_out(self, shard) :
+        # called by a shard at the end of a wakeup that emptied its kernel
+        # queue: directories it saw renamed out of a root, whose IN.MOVED_TO
+        # has still not turned up, have left the roots altogether.
+        for cookie, (owner, pathname) in list(self._moves.items()) :
+            if owner == shard :
+                del self._moves[cookie]
+                self._drop_subtree(pathname)
+            #end if
+        #end for
+    #end _shard_moved_out
+
+    def _note_overflow(self, shard) :
+        # counts an IN.Q_OVERFLOW from shard, and schedules a split of it
+        # if there have been too many lately.
+        if (
+                self._overflow_threshold != None
+            and
+                (self._max_shards == None or len(self._shards) < self._max_shards)
+            and
+                shard not in self._splitting
+        ) :
+            now = time.monotonic()
+            recent = self._overflows.setdefault(shard, deque())
+            recent.append(now)
+            while recent[0] < now - self._overflow_window :
+                recent.popleft()
+            #end while
+            if len(recent) >= self._overflow_threshold :
+                del self._overflows[shard]
+                self._splitting.add(shard)
+                self._loop().call_soon(self._split, shard)
+            #end if
+        #end if
+    #end _note_overflow
+
+    def _split(self, shard) :
+        # adds a new shard and moves every other subtree on shard to it.
+        self._splitting.discard(shard)
+        if self._max_shards == None or len(self._shards) < self._max_shards :
+            new_shard = self.add_shard()
+            moving = sorted \
+              (
+                pathname
+                for pathname, placed in self._subtrees.items()
+                if placed[0] == shard
+              )[::2]
+            for pathname in moving :
+                # watch it on the new shard before dropping it from the old, so
+                # as not to miss anything
+                old_watches = shard.watches_under(pathname)
+                self._place_subtree(pathname, self._subtrees[pathname][1], False, new_shard)
+                self._remove_watches(old_watches)
+            #end for
+            self.nr_splits += 1
         #end if
-        result = Watch(wd, self)
-        result.pathname = pathname
-        result.mask = mask
+    #end _split
+
+    def get_watch(self, pathname) :
+        "returns the Watch for the given pathname from whichever shard has it, or" \
+        " None if it is not being watched."
+        pathname = self._key(pathname)
+        result = None
+        for shard in self._shards :
+            result = shard.get_watch(pathname)
+            if result != None :
+                break
+            #end if
+        #end for
         return \
             result
-    #end watch
+    #end get_watch
 
     @property
     def watches(self) :
-        "returns a list of currently-associated Watch objects."
+        "returns a list of the Watch objects on all shards, sorted by pathname."
         return \
-            sorted(self._watches.values(), key = lambda w : w.pathname)
+            sorted \
+              (
+                (w for shard in self._shards for w in shard.watches),
+                key = lambda w : w.pathname
+              )
     #end watches
 
-    def __del__(self) :
-        if self.fd != None :
-            self._add_remove_watch(False)
-            os.close(self.fd)
-        #end if
-        self.fd = None
-    #end __del__
+    @property
+    def nr_watches(self) :
+        "the total number of watches currently held across all shards."
+        return \
+            sum(shard.nr_watches for shard in self._shards)
+    #end nr_watches
 
-    def fileno(self) :
+    def pause(self) :
+        "pauses reading on all shards; see Watcher.pause()."
+        for shard in self._shards :
+            shard.pause()
+        #end for
+    #end pause
+
+    def resume(self) :
+        "resumes reading on all shards; see Watcher.resume()."
+        for shard in self._shards :
+            shard.resume()
+        #end for
+    #end resume
+
+    def _nr_pending(self) :
         return \
-            self.fd
-    #end fileno
+            sum(len(shard._notifs) for shard in self._shards)
+    #end _nr_pending
 
-    def _callback(self) :
-        # called by asyncio when there is a notification event to be read.
-        fixed_size = ct.sizeof(inotify_event)
-        buf = os.read(self.fd, fixed_size + NAME_MAX + 1)
-        while len(buf) != 0 :
-            assert len(buf) >= fixed_size, "truncated inotify message: expected %d bytes, got %d" % (fixed_size, len(buf))
-            wd, mask, cookie, namelen = struct.unpack("@iIII", buf[:fixed_size])
-            assert len(buf) >= fixed_size + namelen, "truncated rest of inotify message: expected %d bytes, got %d" % (fixed_size + namelen, len(buf))
-            pathname = buf[fixed_size : fixed_size + namelen]
-            buf = buf[fixed_size + namelen:]
-            end = pathname.find(0)
-            if end >= 0 :
-                pathname = pathname[:end]
-            #end if
-            pathname = pathname.decode()
-            if wd >= 0 :
-                watch = self._watches[wd]
-            else :
-                assert mask & IN.Q_OVERFLOW != 0
-                watch = None
+    def _popleft(self) :
+        # takes the next event from the shards in turn, returning None if
+        # none of them has one queued.
+        shards = self._shards
+        result = None
+        for i in range(len(shards)) :
+            shard = shards[(self._next + i) % len(shards)]
+            if len(shard._notifs) != 0 :
+                self._next = (self._next + i + 1) % len(shards)
+                result = shard._popleft()
+                break
             #end if
-            if mask & IN.IGNORED != 0 :
-                # watch is gone
-                watch._parent = None # Watch object doesn’t need to remove itself
-                self._watches.pop(wd)
-            #end if
-            wakeup = len(self._notifs) == 0
-            self._notifs.append(Event(watch, mask, cookie, pathname))
-            if wakeup and len(self._awaiting) != 0 :
-                # wake up task at head of queue
-                # also need to remove it from queue here, in case
-                # anybody else is also waiting behind it and I have
-                # additional incoming messages for them
-                self._awaiting.pop(0).set_result(True)
+        #end for
+        return \
+            result
+    #end _popleft
+
+    def _wake_waiter(self) :
+        # as for Watcher._wake_waiter.
+        while len(self._awaiting) != 0 :
+            awaiting = self._awaiting.popleft()
+            if not awaiting.done() :
+                awaiting.set_result(True)
+                break
             #end if
+            self._nr_stale_waiters -= 1
         #end while
-    #end _callback
-
-    async def get(self, timeout = None) :
-        "waits for and returns the next available Event. Waits forever if" \
-        " necessary if timeout is None; else it is the number of seconds" \
-        " (fractions allowed) to wait; if no event becomes available during" \
-        " that time, None is returned."
+    #end _wake_waiter
 
-        awaiting = None
+    async def _wait(self, timeout) :
+        # waits until an event may have been queued on any shard, returning
+        # False if the timeout (if not None) elapsed first. The shards read
+        # continuously, so unlike Watcher._wait, there is no reader to install.
 
         def timedout(w_awaiting) :
             awaiting = w_awaiting()
@@ -447,43 +4024,57 @@ class Watcher :
             #end if
         #end timedout
 
-    #begin get
+    #begin _wait
         loop = self._loop()
         assert loop != None, "loop has gone away"
-        while True :
-            if len(self._notifs) != 0 :
-                result = self._notifs.pop(0)
-                break
-            #end if
-            awaiting = loop.create_future()
-            timeout_task = None
-            if timeout != None :
-                if timeout <= 0 :
-                    result = None
-                    break
-                #end if
-                timeout_task = loop.call_later(timeout, timedout, weak_ref(awaiting))
-            #end if
-            self._awaiting.append(awaiting)
-            if self._reader_count == 0 :
-                self._add_remove_watch(True)
-            #end if
-            self._reader_count += 1
+        if timeout != None and timeout <= 0 :
+            return \
+                False
+        #end if
+        awaiting = loop.create_future()
+        timeout_task = None
+        if timeout != None :
+            timeout_task = loop.call_later(timeout, timedout, weak_ref(awaiting))
+        #end if
+        self._awaiting.append(awaiting)
+        try :
             got_one = await awaiting
-            self._reader_count -= 1
-            if self._reader_count == 0 :
-                self._add_remove_watch(False)
+        except asyncio.CancelledError :
+            if (
+                    not awaiting.cancelled()
+                and
+                    awaiting.result()
+                and
+                    self._nr_pending() != 0
+            ) :
+                self._wake_waiter()
             #end if
+            raise
+        finally :
             if timeout_task != None :
                 timeout_task.cancel()
             #end if
-            try :
-                self._awaiting.pop(self._awaiting.index(awaiting))
-            except ValueError :
-                pass
-            #end try
-            if not got_one :
-                result = None
+            if awaiting.cancelled() or not awaiting.result() :
+                self._nr_stale_waiters += 1
+                if self._nr_stale_waiters * 2 > len(self._awaiting) :
+                    self._awaiting = deque(f for f in self._awaiting if not f.done())
+                    self._nr_stale_waiters = 0
+                #end if
+            #end if
+        #end try
+        return \
+            got_one
+    #end _wait
+
+    async def get(self, timeout = None) :
+        "waits for and returns the next available Event from any shard, taking" \
+        " them from each shard in turn. timeout is as for Watcher.get()."
+        while True :
+            result = self._popleft()
+            if result != None :
+                break
+            #end if
+            if not await self._wait(timeout) :
                 break
             #end if
         #end while
@@ -491,32 +4082,158 @@ class Watcher :
             result
     #end get
 
+    async def get_batch(self, max_events = None, timeout = None) :
+        "waits until at least one Event is available from any shard, then returns" \
+        " a list of those already queued, as for Watcher.get_batch()."
+        while True :
+            result = self.drain(max_events)
+            if len(result) != 0 :
+                break
+            #end if
+            if not await self._wait(timeout) :
+                break
+            #end if
+        #end while
+        return \
+            result
+    #end get_batch
+
+    def drain(self, max_events = None) :
+        "returns a list of the Events already queued on all shards, up to" \
+        " max_events if this is not None, without waiting. Each shard’s events" \
+        " are kept together, and the shards are taken in turn from one call" \
+        " to the next."
+        shards = self._shards
+        result = []
+        start = self._next
+        for i in range(len(shards)) :
+            if max_events != None and len(result) >= max_events :
+                break
+            #end if
+            shard = shards[(start + i) % len(shards)]
+            result.extend \
+              (
+                shard.drain((lambda : None, lambda : max_events - len(result))[max_events != None]())
+              )
+            self._next = (start + i + 1) % len(shards)
+        #end for
+        return \
+            result
+    #end drain
+
     def iter_async(self, stop_on = None, timeout = None) :
-        "wrapper around get() to allow use with an async-for statement." \
-        " Lets you write\n" \
-        "\n" \
-        "    async for event in «watcher».iter_async(«stop_on», «timeout») :" \
-        "        «process event»\n" \
-        "    #end for\n" \
-        "\n" \
-        "to receive and process notifications in a loop. stop_on is an" \
-        " optional set of STOP_ON.xxx values indicating the conditions" \
-        " under which the iterator will raise StopAsyncIteration to" \
-        " terminate the loop."
-        if stop_on == None :
-            stop_on = frozenset()
-        elif (
-                not isinstance(stop_on, (set, frozenset))
-            or
-                not all(isinstance(elt, STOP_ON) for elt in stop_on)
-        ) :
-            raise TypeError("stop_on must be None or set of STOP_ON")
-        #end if
+        "wrapper around get() to allow use with an async-for statement, as for" \
+        " Watcher.iter_async()."
+        stop_on = _check_stop_on(stop_on)
         return \
             _WatcherAiter(self, stop_on, timeout)
     #end iter_async
 
-#end Watcher
+    def iter_batches(self, max_events = None, stop_on = None, timeout = None) :
+        "wrapper around get_batch() to allow use with an async-for statement, as" \
+        " for Watcher.iter_batches()."
+        stop_on = _check_stop_on(stop_on)
+        return \
+            _WatcherBatchAiter(self, max_events, stop_on, timeout)
+    #end iter_batches
+
+#end ShardedWatcher
+
+class WatcherGroup :
+    "reads the inotify fds of any number of Watchers through a single epoll" \
+    " instance (via the selectors module) with one reader callback on the loop," \
+    " instead of each Watcher having its own. Events still go to each Watcher’s" \
+    " own queue, to be retrieved with its get() and friends. Do not instantiate" \
+    " directly; use the create() method, then pass the group to Watcher.create()."
+
+    __slots__ = \
+        ( # to forestall typos
+            "__weakref__",
+            "_loop",
+            "_selector",
+            "_max_bytes",
+            # statistics, readable by caller:
+            "nr_wakeups",
+            "nr_deferred",
+        )
+
+    @classmethod
+    def create(celf, loop = None, max_bytes = 65536) :
+        "creates a new WatcherGroup on the given loop (the default loop if not" \
+        " specified). max_bytes, if not None, is the most that will be read from" \
+        " any one member’s kernel queue in each wakeup (about 2000 events with" \
+        " short names for the default), so that one busy Watcher cannot hold up" \
+        " the others; what is left is read on the next wakeup, after the other" \
+        " members have had their turn. The count of times this happened is kept" \
+        " in nr_deferred."
+        if loop == None :
+            loop = asyncio.get_event_loop()
+        #end if
+        result = super().__new__(celf)
+        result._loop = weak_ref(loop)
+        result._selector = selectors.DefaultSelector()
+        result._max_bytes = max_bytes
+        result.nr_wakeups = 0
+        result.nr_deferred = 0
+        loop.add_reader(result._selector.fileno(), _group_callback, weak_ref(result))
+        return \
+            result
+    #end create
+
+    def __del__(self) :
+        if self._selector != None :
+            loop = self._loop()
+            if loop != None :
+                loop.remove_reader(self._selector.fileno())
+            #end if
+            self._selector.close()
+            self._selector = None
+        #end if
+    #end __del__
+
+    def __len__(self) :
+        "the number of member Watchers currently wanting to be read."
+        return \
+            len(self._selector.get_map())
+    #end __len__
+
+    def _set_reading(self, watcher, add) :
+        # called by a member Watcher in place of adding or removing its own
+        # reader callback.
+        if self._selector == None :
+            pass
+        elif add :
+            self._selector.register(watcher.fd, selectors.EVENT_READ, weak_ref(watcher))
+        else :
+            try :
+                self._selector.unregister(watcher.fd)
+            except KeyError :
+                pass
+            #end try
+        #end if
+    #end _set_reading
+
+    def _callback(self) :
+        # reads from each member whose fd is ready, up to the limit for each.
+        for key, events in self._selector.select(0) :
+            watcher = key.data()
+            if watcher != None and watcher._callback(self._max_bytes) :
+                self.nr_deferred += 1
+            #end if
+        #end for
+        self.nr_wakeups += 1
+    #end _callback
+
+#end WatcherGroup
+
+def _group_callback(w_group) :
+    # reader callback for a WatcherGroup, holding only a weak reference so as
+    # not to keep it alive.
+    group = w_group()
+    if group != None :
+        group._callback()
+    #end if
+#end _group_callback
 
 class _WatcherAiter :
     # internal class for use by Watcher.iter_async (above).
@@ -544,13 +4261,40 @@ class _WatcherAiter :
 
 #end _WatcherAiter
 
+class _WatcherBatchAiter :
+    # internal class for use by Watcher.iter_batches (above).
+
+    def __init__(self, watcher, max_events, stop_on, timeout) :
+        self.watcher = watcher
+        self.max_events = max_events
+        self.stop_on = stop_on
+        self.timeout = timeout
+    #end __init__
+
+    def __aiter__(self) :
+        # I’m my own iterator.
+        return \
+            self
+    #end __aiter__
+
+    async def __anext__(self) :
+        result = await self.watcher.get_batch(max_events = self.max_events, timeout = self.timeout)
+        if len(result) == 0 and STOP_ON.TIMEOUT in self.stop_on :
+            raise StopAsyncIteration("Watcher.iter_batches terminating")
+        #end if
+        return \
+            result
+    #end __anext__
+
+#end _WatcherBatchAiter
+
 #+
 # Cleanup
 #-
 
 def _atexit() :
     # disable all __del__ methods at process termination to avoid segfaults
-    for cls in Watch, Watcher :
+    for cls in Watch, Watcher, WatcherGroup :
         delattr(cls, "__del__")
     #end for
 #end _atexit